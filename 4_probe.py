@@ -1,12 +1,60 @@
-from deviceControl_4probe import MultiprocConnector, DevControl, dataBuff, NUM_SAMPLES, NANO2MILI
-import matplotlib.pyplot as plt
+from deviceControl_4probe import MultiprocConnector, HeadlessConnector, DevControl, dataBuff, impedanceSpectrum, \
+    loadDriver, decimateMinMax
 import multiprocessing as mp
-import sys
+import queue
 from datetime import datetime
 import csv
+import numpy as np
+from ivsLog import LogTailer
+from rawRecorder import RawRecorder, ReplayDevice
+from pipeline import AcquisitionPipeline, DutyCycle
+from telemetry import TelemetryServer
+import metrics
 
 #if False, it uses the settings of the IVS computer
 Debugging=False
+#if True, a simulated PS2000 is used instead of the oscilloscope (no hardware or DLL needed)
+Simulated=False
+#if True, nothing is plotted: matplotlib is never imported and no plotting process is started (unattended runs)
+Headless=False
+#'block': one block capture per window, 'streaming': continuous gapless windows from the streaming API
+acquisitionMode='block'
+#'rms': broadband RMS of every capture (no phase), 'lockin': amplitude and phase at SIGNAL_FREQ only
+#(rejects noise and harmonics). The phase is the one of channel A relative to channel B: B is the generator side of
+#OUTPUTIMP, in phase with the current only if the load is resistive, so it is not the phase of the impedance
+estimator='rms'
+#if True, the oscilloscope only captures the burst that fills the stats window before every measurement point
+#(points every Measurement_Rate ms of wall-clock time) and is idle in between, otherwise it captures continuously
+dutyCycled=False
+#if True, captures far from the median of the window (glitches, bubbles) are left out of the stats (see robustStats)
+robust=False
+#when processing falls behind the oscilloscope: 'drop' the oldest waiting capture, or 'block' the acquisition
+framePolicy='drop'
+#serial numbers of the oscilloscopes to run in parallel (one process and one output file each),
+#empty: only the first unit found
+Serials=[]
+#telemetry from the oscilloscope processes: queued messages (dropped when full), points per plotted capture
+TELEMETRY_QUEUE=64
+TELEMETRY_POINTS=1000
+#if set ("localhost:port", or the path of a Unix domain socket except on Windows), waveforms, stats and measurement points
+#are published there for any number of subscribers (see telemetry.py)
+telemetryAddress=''
+#if True, the voltage range of each channel follows the signal (up at once on clipping, down after a few small captures),
+#otherwise both channels stay at the range set from SIGNAL_AMPL
+autoRange=False
+#if set to (start Hz, stop Hz, increment Hz, dwell s), e.g. deviceControl_4probe.SWEEP, the generator sweeps
+#and every measurement point also saves the impedance of every step into Picospectrum_<date>.csv
+sweep=None
+#if True, the time spent in every stage and the event counters are written to filePath/metrics_<date>.txt
+#every metrics.METRICS_INTERVAL seconds, and summed up when the acquisition stops
+recordMetrics=False
+#options of the simulated unit (see simulatedPS2000.SimulatedPS2000)
+simulatorOptions={'noise': 1.0, 'latency': 0.0, 'overflow_prob': 0.0, 'realtime': True}
+#if True, every raw capture is recorded (int16 ADC counts, see rawRecorder) into filePath/raw_<date>
+recordRaw=False
+compressRaw=False
+#if set, the captures are replayed from this recording instead of read from the oscilloscope
+replayPath=''
 
 if not Debugging:
 ###################### defining paths on the experiment computer ###########
@@ -22,6 +70,9 @@ else:
     logPath = "InVitroApp.txt" ##where to find the log
     Measurement_Rate = 2000
 
+#keeps the latest log values, reading only what the IVS appends to the log
+logTailer=LogTailer(logPath)
+
 default_temp=33.0
 default_conc=400.0
 
@@ -38,18 +89,25 @@ TIMEthres=10000000
 #output fields of the output CSV file
 outputFields=['concentration [mg/dL]', 'target concentration [mg/dL]', 'volume [mL]',  'temperature [Celsius]',
               'V2 mean [mV]', 'V2 std [uV]', 'I mean [mA]',
-              'I std [uA]', 'conductivity [mS]','compensated conductivity [mS]', 'timestamp']
+              'I std [uA]', 'conductivity [mS]','compensated conductivity [mS]',
+              'impedance [Ohm]', 'phase A-B [deg]', 'timestamp']
+#output fields of the spectrum CSV file (one row per sweep step)
+spectrumFields=['frequency [Hz]', 'V2 mean [mV]', 'V2 std [uV]', 'I mean [mA]', 'I std [uA]',
+                'impedance [Ohm]', 'phase A-B [deg]', 'captures', 'timestamp']
 
 class measurement:
     '''a class for one measurement point'''
-    def __init__(self, Vavg, Vstd, Iavg, Istd):
-        self.timestamp=datetime.today()
+    def __init__(self, Vavg, Vstd, Iavg, Istd, timestamp=None, phase=0.0):
+        self.timestamp=datetime.today() if timestamp is None else timestamp
         self.timestring=datetime.strftime(self.timestamp, '%d/%m/%Y %H:%M')
         self.Vrms=Vavg # Average voltage measured from Channel A on Picoscope
         self.Vstd=Vstd # standard deviation of the above
         self.Irms=Iavg # average current measured through Channel B
         self.Istd = Istd
         self.conductivity=Iavg/Vavg*1000 # in mSiemens
+        self.phase=phase # phase of channel A relative to channel B, in degrees (nan if not measured)
+        self.impedance=Vavg/Iavg # magnitude, in Ohm
+        self.spectrum=None # impedanceSpectrum.getSpectrum() when sweeping
 
     def formatOutput(self):
        return {'concentration [mg/dL]': self.concentration,
@@ -62,25 +120,21 @@ class measurement:
          'I std [uA]': self.Istd,
          'conductivity [mS]': self.conductivity,
          'compensated conductivity [mS]': self.conductivity_compensated,
+         'impedance [Ohm]': self.impedance,
+         'phase A-B [deg]': self.phase,
          'timestamp': self.timestring}
 
     def getLog(self):
-        '''open log file and gets the last volume and concentration'''
+        '''gets the last volume and concentration from the log (only the new part of the log is read).
+        A replayed point gets the values logged up to its capture time'''
         try:
-            with open(logPath, 'r', encoding='utf8') as f:
-                f = f.readlines()
-                for line in f:
-                    if "Current concentration" in line:
-                        lastconcentration = line
-                    if "Current volume" in line:
-                        lastvolume = line
-                    if "Temperature step function" in line:
-                        lasttemperature=line
-                    if 'Concentration step change to ' in line:
-                        conc_theoretical=line
+            fields = logTailer.valuesAt(self.timestamp) if replayPath else logTailer.latest()
+            values = [fields[key][0] for key in ('concentration', 'volume', 'temperature', 'theoretical_conc')]
+            if None in values:
+                raise ValueError("unreadable log line")
 
             #checking if the timestamps are close enough
-            date = datetime.strptime(lastconcentration.split(' [')[0], '%d/%m/%Y %H:%M')
+            date = fields['concentration'][1]
             tdiff=int(abs((date - self.timestamp).total_seconds()) / 60) #in minutes
             if tdiff > TIMEthres:#the timestamp is too old
                 print ("Too old concentration values...")
@@ -91,14 +145,7 @@ class measurement:
                 self.temperature = 0
                 self.theoretical_conc=0
             else:
-                c = lastconcentration.split('Current concentration')[1].split('\n')[0]
-                self.concentration = float(c) if c is not None else None
-                v=lastvolume.split('Current volume')[1].split('\n')[0]
-                self.volume = float(v) if v is not None else None
-                t = lasttemperature.split('to ')[1].split('degrees')[0]
-                self.temperature=  float(t) if t is not None else None
-                t_c=conc_theoretical.split('Concentration step change to ')[1].split(' in')[0]
-                self.theoretical_conc=float(t_c) if t_c is not None else None
+                self.concentration, self.volume, self.temperature, self.theoretical_conc = values
         except:
             #if another exception occured (for example the volume was not readable)
             self.concentration=-1
@@ -111,18 +158,19 @@ class measurement:
               "volume: {:.2f} ml\n\t".format(self.volume),
               " V2: {:.3f} mV\n\t".format(self.Vrms),
               " I: {:.3f} mA\n\t".format(self.Irms),
-              "G: {:.3f} mS ".format(self.conductivity))
+              "G: {:.3f} mS\n\t".format(self.conductivity),
+              "Z: {:.1f} Ohm, A-B phase: {:.2f} deg ".format(self.impedance, self.phase))
     def compensate(self, t0):
-        self.compensateEvaporation(t0)
-        self.compensateTemperature()
-    def compensateEvaporation(self, t0):
+        '''t0: when the liquid was last replaced, evaporation is counted from then'''
         timedelay = (self.timestamp - t0).total_seconds() / 60
-        self.conductivity_compensated = self.conductivity/ (1 + evaporation_coeff * timedelay)
-        return
-    def compensateTemperature(self):
-        self.conductivity_compensated = self.conductivity_compensated / \
-                                        (1 + temperature_coeff * (self.temperature - default_temp))
-        return
+        self.conductivity_compensated = compensateConductivity(self.conductivity, timedelay, self.temperature,
+                                                               evaporation_coeff, temperature_coeff, default_temp)
+
+def compensateConductivity(conductivity, timedelay, temperature, evaporation_coeff, temperature_coeff, default_temp):
+    '''conductivity compensated for the evaporation during timedelay minutes and for the temperature.
+    Works on arrays as well: reprocess.py recomputes saved points with it'''
+    compensated = conductivity / (1 + evaporation_coeff * timedelay)
+    return compensated / (1 + temperature_coeff * (temperature - default_temp))
 
 def initOutput(filename):
     '''initializing the output csv file'''
@@ -136,63 +184,302 @@ def appendRow(filename, m):
         writer = csv.DictWriter(results, fieldnames=outputFields)
         writer.writerow(m.formatOutput())
 
-def main():
-    ''' main function '''
-    counter = Measurement_Rate #counts down to 0
+def spectrumName(filename):
+    return filename.replace('Picoresults', 'Picospectrum')
+
+def initSpectrum(filename):
+    '''initializing the spectrum csv file'''
+    with open(filename, mode='w',  newline='') as results:
+        writer = csv.DictWriter(results, fieldnames=spectrumFields)
+        writer.writeheader()
+
+def appendSpectrum(filename, m):
+    '''appends one row per sweep step of the measurement point m'''
+    s = m.spectrum
+    impedance = s['Vavg'] / s['Iavg']
+    with open(filename, mode='a', newline='') as results:
+        writer = csv.DictWriter(results, fieldnames=spectrumFields)
+        for i in range(len(s['frequency'])):
+            writer.writerow({'frequency [Hz]': s['frequency'][i],
+                             'V2 mean [mV]': s['Vavg'][i],
+                             'V2 std [uV]': s['Vstd'][i],
+                             'I mean [mA]': s['Iavg'][i],
+                             'I std [uA]': s['Istd'][i],
+                             'impedance [Ohm]': impedance[i],
+                             'phase A-B [deg]': s['phase'][i],
+                             'captures': s['count'][i],
+                             'timestamp': m.timestring})
+
+def openDevice(serial=None):
+    '''the recording to replay, the simulated unit or the oscilloscope (with the given serial number)'''
+    if replayPath:
+        return ReplayDevice(replayPath)
+    elif Simulated:
+        options = dict(simulatorOptions, serial=serial) if serial else simulatorOptions
+        return DevControl(driver=loadDriver('simulated', **options), mode=acquisitionMode, serial=serial, autoRange=autoRange,
+                         sweep=sweep)
+    else:
+        return DevControl(mode=acquisitionMode, serial=serial, autoRange=autoRange,
+                         sweep=sweep)
+
+class measurementStage:
+    '''processing stage of the pipeline: adds every capture to the stats buffer, shows it,
+    and returns a valid measurement point every Measurement_Rate ms (of capture time, not of capture count).
+    spectrum: impedanceSpectrum also fed with every capture when the generator sweeps
+    schedule: the DutyCycle of the acquisition: a point is then made after the frames marked pointDue
+    telemetry: TelemetryServer (or queueTelemetry) getting the decimated capture and the stats, as source'''
+    def __init__(self, stats, showData, spectrum=None, schedule=None, telemetry=None, source=''):
+        self.stats = stats
+        self.showData = showData
+        self.spectrum = spectrum
+        self.schedule = schedule
+        self.telemetry = telemetry
+        self.source = source
+        self.deadline = None #capture time (s) of the next point
+        self.accepted = None #schedule generation of the last point saved
+        #important for evaporation compensation: the liquid is default_conc since the first capture
+        self.t0=None
+        self.current_conc=default_conc
+
+    def __call__(self, frame):
+        #channel A: Voltage
+        #channel B: current
+        #bufA, bufB: wave values-->used for plotting
+        if self.t0 is None:
+            self.t0 = datetime.fromtimestamp(frame.captureTime)
+        with metrics.span('addMeasurement'):
+            self.stats.addMeasurement(frame.bufA, frame.bufB, frame.interval_ns / 1e9)
+            if self.spectrum is not None:
+                self.spectrum.addMeasurement(frame.bufA, frame.bufB, frame.interval_ns / 1e9)
+
+        #update the plot with the new data
+        with metrics.span('showData'):
+            self.showData(frame.time, frame.bufA, frame.bufB)
+        if self.telemetry is not None and self.telemetry.subscribers:
+            with metrics.span('telemetry'):
+                self.publish(frame)
+        if frame.pointDue is None:
+            if self.deadline is None:
+                self.deadline = frame.captureTime + Measurement_Rate / 1000
+            pointDue = frame.captureTime >= self.deadline
+        else:
+            #a capture in flight when the point of its burst was accepted makes no second point
+            pointDue = frame.pointDue and frame.generation != self.accepted
+
+        if pointDue:
+            ## gets averages and standard deviations
+            Vavg, Vstd, Iavg, Istd=self.stats.getStats()
+            ## format the measurement point into one class
+            phase, phase_std=self.stats.getPhase()
+            m=measurement(Vavg, Vstd, Iavg, Istd, datetime.fromtimestamp(frame.captureTime) if replayPath else None, phase)
+            ## adds volume and concentration values from the log
+            with metrics.span('getLog'):
+                m.getLog()
+            ##if liquid was replaced, evaporation resets: only at a saved point, as reprocess.py sees the file
+            #(a rejected point, e.g. of an unreadable log, leaves the start unchanged)
+            t0 = m.timestamp if self.current_conc != m.concentration else self.t0
+            m.compensate(t0)
+            Vstd, Istd = m.Vstd, m.Istd
+            if self.spectrum is not None:
+                m.spectrum = self.spectrum.getSpectrum()
+                #the broadband stats follow the sweep: the noise is judged step by step
+                Vstd, Istd = m.spectrum['Vstd'].max(), m.spectrum['Istd'].max()
+            #if the measurement point was valid, it is saved
+            if m.concentration is not None and m.volume is not None:
+                if m.volume >= VOLthres and Vstd < STDthres and Istd < STDthres:
+                    # next deadline, the ones missed while the points were rejected are skipped
+                    if self.deadline is not None:
+                        while self.deadline <= frame.captureTime:
+                            self.deadline = self.deadline + Measurement_Rate / 1000
+                    if self.schedule is not None:
+                        self.accepted = frame.generation
+                        self.schedule.pointDone(True, frame.generation)
+                    self.current_conc, self.t0 = m.concentration, t0
+                    metrics.count('points')
+                    return m
+            if self.schedule is not None:
+                self.schedule.pointDone(False, frame.generation)
+            metrics.count('points_rejected')
+        return None
+
+    def publish(self, frame):
+        t, a = decimateMinMax(frame.time, frame.bufA, TELEMETRY_POINTS)
+        t, b = decimateMinMax(frame.time, frame.bufB, TELEMETRY_POINTS)
+        self.telemetry.publishWaveform(self.source, t, a, b)
+        Vavg, Vstd, Iavg, Istd = self.stats.getStats()
+        phase, phaseStd = self.stats.getPhase()
+        self.telemetry.publishStats(self.source, Vavg, Vstd, Iavg, Istd, phase, phaseStd,
+                                    self.stats.num_samples, self.stats.rejected)
+
+def runAcquisition(dev, stats, filename, showData, recorder=None, stop=None, onPoint=None, telemetry=None,
+                   source=''):
+    '''acquisition loop: captures, averages and saves a measurement point every Measurement_Rate ms
+    until stop (an Event) is set, Ctrl-C or the end of a replay.
+    Capturing, processing and writing run in parallel (see pipeline.AcquisitionPipeline).
+    showData(time, bufA, bufB) gets every capture, onPoint(m) every saved measurement point.
+    telemetry (TelemetryServer, or queueTelemetry in an oscilloscope process) publishes the captures,
+    stats and points as source.
+    When sweep is set, the impedance spectrum of every point is saved as well'''
+    spectrum = impedanceSpectrum(sweep) if sweep else None
+    if spectrum is not None and saveOutput:
+        initSpectrum(spectrumName(filename))
+
+    def persist(m):
+        if saveOutput:
+            with metrics.span('appendRow'):
+                appendRow(filename, m)
+            if m.spectrum is not None:
+                appendSpectrum(spectrumName(filename), m)
+        if onPoint is not None:
+            onPoint(m)
+        if telemetry is not None:
+            telemetry.publishMeasurement(source, m.formatOutput(), m.timestamp.timestamp())
+
+    def record(frame):
+        recorder.addCapture(frame.rawA, frame.rawB, frame.timebase, frame.rangeA, frame.rangeB,
+                            frame.interval_ns, frame.overflow, frame.captureTime)
+
+    #a replay keeps its recorded timing
+    schedule = DutyCycle(Measurement_Rate / 1000, stats.size) if dutyCycled and not replayPath else None
+    #a replay is never faster than its processing, and a burst must not lose its last capture: nothing is dropped
+    policy = 'block' if replayPath or schedule is not None else framePolicy
+    stage = measurementStage(stats, showData, spectrum, schedule, telemetry, source)
+    pipeline = AcquisitionPipeline(dev, stage, persist, record if recorder is not None else None, policy, stop,
+                                   schedule=schedule)
+    pipeline.run()
+
+def sendTelemetry(telemetry, message):
+    '''puts message on the telemetry queue, drops it if the queue is full: acquisition never waits'''
+    try:
+        telemetry.put_nowait(message)
+    except queue.Full:
+        metrics.count('telemetry_dropped')
+
+class queueTelemetry:
+    '''telemetry of an oscilloscope process: sent through the telemetry queue to the supervising process,
+    which plots the captures and publishes everything on its TelemetryServer'''
+    def __init__(self, telemetry, waveforms=True, stats=True):
+        self.telemetry = telemetry
+        self.waveforms = waveforms
+        self.stats = stats
+        self.subscribers = waveforms or stats
+
+    def publishWaveform(self, source, time, chA, chB):
+        if self.waveforms:
+            sendTelemetry(self.telemetry, ('frame', source, np.array(time), np.array(chA), np.array(chB)))
+
+    def publishStats(self, source, *values):
+        if self.stats:
+            sendTelemetry(self.telemetry, ('stats', source, values))
+
+    def publishMeasurement(self, source, fields, timestamp):
+        sendTelemetry(self.telemetry, ('point', source, fields, timestamp))
+
+def scopeWorker(serial, telemetry, stop):
+    '''acquisition process of one oscilloscope: own device, stats buffer and output file.
+    Decimated captures and the saved points go to the shared telemetry queue'''
+    #exiting must not wait for the queue to be drained
+    telemetry.cancel_join_thread()
+    dev = None
+    recorder = None
     try:
-        filename = datetime.strftime(datetime.now(), filePath + 'Picoresults_%Y_%m_%d_%H_%M.csv')
+        filename = datetime.strftime(datetime.now(), filePath + 'Picoresults_' + serial + '_%Y_%m_%d_%H_%M.csv')
         if saveOutput:
             initOutput(filename)
-        #connecting to the GUI to see the graph in real time
-        connector = MultiprocConnector()
-        #initializing the device
-        dev = DevControl()
-        #stats is the buffer that stores the actual measurements
-        stats = dataBuff()
-        #important for evaporation compensation
-        t0=datetime.now()
-        current_conc=default_conc
-
-        while True:
-            #reads data from the oscilloscope
-            #channel A: Voltage
-            #channel B: current
-            #bufA, bufB: wave values-->used for plotting
-            time, bufA, bufB = dev.getData()
-            stats.addMeasurement(bufA, bufB)
-
-            #update the plot with the new data
-            connector.updateData(time, bufA, bufB)
-            ##counting back for 5 minutes
-            counter=counter - dev.timeInterval.value * NUM_SAMPLES / NANO2MILI
-
-            if counter<1:
-                ## gets averages and standard deviations
-                Vavg, Vstd, Iavg, Istd=stats.getStats()
-                ## format the measurement point into one class
-                m=measurement(Vavg, Vstd, Iavg, Istd)
-                ## adds volume and concentration values from the log
-                m.getLog()
-                ##if liquid was replaced, evaporation resets
-                if current_conc != m.concentration:
-                    current_conc==m.concentration
-                    t0= m.timestamp
-                m.compensate(t0)
-                #if the measurement point was valid, it saves it in the CSV file
-                if m.concentration is not None and m.volume is not None:
-                    if m.volume >= VOLthres and m.Vstd < STDthres and m.Istd < STDthres:
-                        if saveOutput:
-                            appendRow(filename, m)
-                        # resets counter
-                        counter = Measurement_Rate
+        if recordMetrics:
+            metrics.enable(datetime.strftime(datetime.now(), filePath + 'metrics_' + serial + '_%Y_%m_%d_%H_%M.txt'))
+        dev = openDevice(serial)
+        if recordRaw:
+            recorder = RawRecorder(datetime.strftime(datetime.now(), filePath + 'raw_' + serial + '_%Y_%m_%d_%H_%M'),
+                                   compress=compressRaw)
+        stats = dataBuff(estimator=estimator, robust=robust)
+        #to the supervisor: the decimated captures for the plot and the subscribers, the stats for the subscribers,
+        #and the saved points
+        forward = queueTelemetry(telemetry, not Headless or bool(telemetryAddress), bool(telemetryAddress))
+        runAcquisition(dev, stats, filename, lambda time, bufA, bufB: None, recorder, stop,
+                       telemetry=forward, source=serial)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if dev is not None:
+            dev.closeDevice()
+        if recorder is not None:
+            recorder.close()
+        metrics.disable()
 
+def superviseScopes(serials):
+    '''runs one acquisition process per oscilloscope, so a slow unit does not hold up the others.
+    Their captures and points come back through one telemetry queue: the captures of the first unit are plotted'''
+    telemetry = mp.Queue(TELEMETRY_QUEUE)
+    stop = mp.Event()
+    workers = [mp.Process(target=scopeWorker, args=(serial, telemetry, stop), name='scope ' + serial)
+               for serial in serials]
+    if recordMetrics: #the plot and the telemetry queue (every unit records its own metrics)
+        metrics.enable(datetime.strftime(datetime.now(), filePath + 'metrics_supervisor_%Y_%m_%d_%H_%M.txt'))
+    connector = HeadlessConnector() if Headless else MultiprocConnector()
+    server = TelemetryServer(telemetryAddress, outputFields[:-1]) if telemetryAddress else None
+    for worker in workers:
+        worker.start()
+    try:
+        while any(worker.is_alive() for worker in workers):
+            try:
+                message = telemetry.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if message[0] == 'frame':
+                if message[1] == serials[0]:
+                    connector.updateData(*message[2:])
+                if server is not None:
+                    server.publishWaveform(*message[1:])
+            elif message[0] == 'stats' and server is not None:
+                server.publishStats(message[1], *message[2])
+            elif message[0] == 'point':
+                print(message[1] + ": conductivity {:.3f} mS".format(message[2]['conductivity [mS]']))
+                if server is not None:
+                    server.publishMeasurement(*message[1:])
     except KeyboardInterrupt:
         print('Interrupted')
+    stop.set()
+    for worker in workers:
+        worker.join(timeout=5)
+        if worker.is_alive():
+            print(worker.name + " did not stop, terminating it")
+            worker.terminate()
+    connector.sendFinished()
+    if server is not None:
+        server.close()
+    metrics.disable()
+
+def main():
+    ''' main function '''
+    if Serials:
+        superviseScopes(Serials)
+        return
+    filename = datetime.strftime(datetime.now(), filePath + 'Picoresults_%Y_%m_%d_%H_%M.csv')
+    if saveOutput:
+        initOutput(filename)
+    if recordMetrics:
+        metrics.enable(datetime.strftime(datetime.now(), filePath + 'metrics_%Y_%m_%d_%H_%M.txt'))
+    #connecting to the GUI to see the graph in real time (unless headless)
+    connector = HeadlessConnector() if Headless else MultiprocConnector()
+    #initializing the device
+    dev = openDevice()
+    recorder = None
+    if recordRaw:
+        recorder = RawRecorder(datetime.strftime(datetime.now(), filePath + 'raw_%Y_%m_%d_%H_%M'), compress=compressRaw)
+    #stats is the buffer that stores the actual measurements
+    stats = dataBuff(estimator=estimator, robust=robust)
+    server = TelemetryServer(telemetryAddress, outputFields[:-1]) if telemetryAddress else None
+    try:
+        runAcquisition(dev, stats, filename, connector.updateData, recorder, telemetry=server)
+    finally:
+        if server is not None:
+            server.close()
         connector.sendFinished()
         dev.closeDevice()
-        sys.exit(1)
+        if recorder is not None:
+            recorder.close()
+        metrics.disable()
 
-    plt.show()
 if __name__ == '__main__':
     main()
-
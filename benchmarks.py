@@ -0,0 +1,242 @@
+
+# Benchmarks of the acquisition and analysis hot paths, on synthetic data (no oscilloscope needed).
+# The results are saved as JSON, and compared with an earlier run to catch regressions:
+#
+#   python benchmarks.py --out before.json
+#   python benchmarks.py --out after.json --compare before.json
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+
+#the plotting process started by MultiprocConnector must not need a display
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+from deviceControl_4probe import dataBuff, DevControl, MultiprocConnector, loadDriver, NUM_SAMPLES
+from ivsLog import LogTailer
+
+#a benchmark is slower than its baseline if its time relative to the reference workload grew by more than TOLERANCE
+#and the quartiles of the two runs do not overlap: a slowdown beyond the noise of the machine
+TOLERANCE=0.25
+#repeats of every benchmark: the statistics are the mean of the middle half of the repeats (interquartile mean)
+REPEAT=15
+#calls of the reference workload timed after every repeat of a benchmark
+REFERENCE_CALLS=20
+REFERENCE_DATA=np.random.default_rng(1).normal(size=4096)
+#window sizes of the dataBuff benchmark
+WINDOW_SIZES=(10, 100, 1000, 10000)
+
+def reference():
+    '''fixed workload (numpy and plain Python) timed next to every benchmark: the speed of the machine drifts
+    by tens of percent within seconds (other processes, CPU clock), the ratio to the reference much less'''
+    np.sort(REFERENCE_DATA)
+    sum(i * i for i in range(1000))
+
+def iqm(values):
+    '''interquartile mean, first and third quartile'''
+    values=np.asarray(values)
+    p25, p75=np.percentile(values, (25, 75))
+    return float(values[(values >= p25) & (values <= p75)].mean()), float(p25), float(p75)
+
+def timeit(fn, number, repeat=REPEAT):
+    '''runs fn number times, repeat times over, each time followed by the reference workload.
+    Returns statistics of the time per call in us over the repeats (interquartile mean, quartiles, median,
+    min and max), and the interquartile mean and quartiles of its ratio to the reference'''
+    fn() #warm up
+    times=[]
+    ratios=[]
+    for r in range(repeat):
+        start=time.perf_counter()
+        for i in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number * 1e6)
+        start=time.perf_counter()
+        for i in range(REFERENCE_CALLS):
+            reference()
+        ratios.append(times[-1] / ((time.perf_counter() - start) / REFERENCE_CALLS * 1e6))
+    mean, p25, p75=iqm(times)
+    relative, relative25, relative75=iqm(ratios)
+    return {'iqm_us': mean, 'p25_us': p25, 'p75_us': p75, 'median_us': float(np.median(times)),
+            'min_us': min(times), 'max_us': max(times), 'calls': number,
+            'relative': relative, 'relative_p25': relative25, 'relative_p75': relative75}
+
+def benchAddMeasurement(results, quick):
+    '''dataBuff.addMeasurement of one capture, with a full window of every size'''
+    rng=np.random.default_rng(0)
+    chA=rng.normal(0, 300, NUM_SAMPLES).astype(np.float32)
+    chB=rng.normal(0, 900, NUM_SAMPLES).astype(np.float32)
+    for estimator in ('rms', 'lockin'):
+        for size in WINDOW_SIZES:
+            stats=dataBuff(size, estimator)
+            for i in range(size):
+                stats.addMeasurement(chA, chB, 20480e-9)
+            results['addMeasurement.' + estimator + '.' + str(size)]=timeit(
+                lambda: stats.addMeasurement(chA, chB, 20480e-9), 200 if quick else 2000)
+
+def benchRetrieveCh(results, quick):
+    '''retrieveCh from the simulated unit (the simulator generating the samples included),
+    and convertCh + getTimeAxis alone (ADC counts to mV and the time axis)'''
+    dev=DevControl(driver=loadDriver('simulated', noise=0.0, realtime=False))
+    dev.getData()
+
+    def retrieve():
+        dev.startBlock()
+        dev.retrieveCh()
+
+    def convert():
+        dev.convertCh()
+        dev.getTimeAxis()
+
+    results['retrieveCh.simulated']=timeit(retrieve, 100 if quick else 1000)
+    results['retrieveCh.convert']=timeit(convert, 500 if quick else 5000)
+    dev.closeDevice()
+
+def benchUpdateData(results, quick):
+    '''MultiprocConnector.updateData: frames published to the plotting process, and the MB/s it means'''
+    connector=MultiprocConnector()
+    try:
+        t=np.linspace(0, 40, NUM_SAMPLES, dtype=np.float32)
+        a=np.sin(t)
+        b=np.cos(t)
+        r=timeit(lambda: connector.updateData(t, a, b), 500 if quick else 5000)
+        r['MB_per_s']=3 * t.nbytes / r['iqm_us']
+        results['updateData.' + str(NUM_SAMPLES)]=r
+    finally:
+        connector.sendFinished()
+
+def writeLog(path, megabytes):
+    '''synthetic IVS log of about megabytes MB, ending with a line of every field'''
+    line=("17/10/2026 10:00 [Info] Pump running, flow {:d} ml/min, nothing to see in this line\n" * 9 +
+          "17/10/2026 10:00 [Info] Current volume 50.{:d}\n")
+    block=''.join(line.format(*([i % 10] * 10)) for i in range(1000)).encode('utf8')
+    with open(path, 'wb') as f:
+        for i in range(int(megabytes * 2 ** 20 // len(block)) + 1):
+            f.write(block)
+        f.write(b"17/10/2026 10:00 [Info] Current concentration 400\n"
+                b"17/10/2026 10:00 [Info] Temperature step function to 33 degrees\n"
+                b"17/10/2026 10:00 [Info] Concentration step change to 400 in 10 minutes\n")
+
+def benchGetLog(results, quick, directory, megabytes):
+    '''measurement.getLog on a large log: the first call (backward search from the end),
+    then the calls after a line is appended (only the new bytes are read)'''
+    probe=importlib.import_module('4_probe')
+    path=os.path.join(directory, 'InVitroApp.txt')
+    writeLog(path, megabytes)
+    m=probe.measurement(100.0, 5.0, 0.1, 0.5)
+    devnull=open(os.devnull, 'w')
+    stdout=sys.stdout
+    sys.stdout=devnull #getLog prints every point
+    try:
+        def first():
+            probe.logTailer=LogTailer(path)
+            m.getLog()
+
+        def appended():
+            with open(path, 'a') as f:
+                f.write("17/10/2026 10:01 [Info] Current volume 49.9\n")
+            m.getLog()
+
+        results['getLog.first.{:g}MB'.format(megabytes)]=timeit(first, 5 if quick else 20)
+        results['getLog.appended.{:g}MB'.format(megabytes)]=timeit(appended, 50 if quick else 500)
+    finally:
+        sys.stdout=stdout
+        devnull.close()
+    os.remove(path)
+
+def benchAppendRow(results, quick, directory):
+    '''appendRow of one measurement point to the output CSV'''
+    probe=importlib.import_module('4_probe')
+    filename=os.path.join(directory, 'Picoresults_bench.csv')
+    probe.initOutput(filename)
+    m=probe.measurement(100.0, 5.0, 0.1, 0.5)
+    m.concentration, m.volume, m.temperature, m.theoretical_conc=400.0, 50.0, 33.0, 400.0
+    m.compensate(m.timestamp)
+    r=timeit(lambda: probe.appendRow(filename, m), 200 if quick else 2000)
+    r['rows_per_s']=1e6 / r['iqm_us']
+    results['appendRow']=r
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    '''prints the change of every benchmark against the baseline (relative to the reference workload),
+    returns the names that got slower. Baselines saved without the reference are compared by their median time'''
+    slower=[]
+    print('{:<34s}{:>14s}{:>14s}{:>9s}'.format('benchmark', 'baseline us', 'now us', 'change'))
+    for name, r in sorted(results.items()):
+        if name not in baseline:
+            print('{:<34s}{:>14s}{:>14.2f}'.format(name, '-', r['iqm_us']))
+            continue
+        b=baseline[name]
+        if 'relative' in b:
+            change=r['relative'] / b['relative'] - 1
+            beyondNoise=r['relative_p25'] > b['relative_p75']
+        else:
+            change=r['median_us'] / b['median_us'] - 1
+            beyondNoise=r['min_us'] > b['max_us']
+        flag=''
+        if change > tolerance and beyondNoise:
+            flag=' SLOWER'
+            slower.append(name)
+        print('{:<34s}{:>14.2f}{:>14.2f}{:>+8.0%}'.format(name, b.get('iqm_us', b['median_us']), r['iqm_us'], change) + flag)
+    return slower
+
+def main():
+    ''' main function '''
+    parser=argparse.ArgumentParser(description='benchmarks of the acquisition and analysis hot paths')
+    parser.add_argument('--out', default='', help='JSON file to save the results in')
+    parser.add_argument('--compare', default='', help='JSON results of an earlier run: exit code 1 if slower')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed slowdown (0.2: 20%%)')
+    parser.add_argument('--log-mb', type=float, default=2048, help='size of the synthetic IVS log in MB')
+    parser.add_argument('--quick', action='store_true', help='fewer calls per benchmark')
+    parser.add_argument('--only', default='', help='run only the benchmarks whose name starts with this')
+    args=parser.parse_args()
+
+    benchmarks=[('addMeasurement', lambda r, d: benchAddMeasurement(r, args.quick)),
+                ('retrieveCh', lambda r, d: benchRetrieveCh(r, args.quick)),
+                ('updateData', lambda r, d: benchUpdateData(r, args.quick)),
+                ('getLog', lambda r, d: benchGetLog(r, args.quick, d, args.log_mb)),
+                ('appendRow', lambda r, d: benchAppendRow(r, args.quick, d))]
+    results={}
+    directory=tempfile.mkdtemp(prefix='picobench_')
+    devnull=open(os.devnull, 'w')
+    try:
+        for name, bench in benchmarks:
+            if not name.startswith(args.only):
+                continue
+            print('running ' + name + '...')
+            stdout=sys.stdout
+            sys.stdout=devnull #the device and the connector report every step
+            try:
+                bench(results, directory)
+            finally:
+                sys.stdout=stdout
+    finally:
+        devnull.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report={'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.platform() + ' ' + platform.processor(),
+            'results': results}
+    text=json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline=json.load(f)['results']
+        slower=compare(results, baseline, args.tolerance)
+        if slower:
+            print(str(len(slower)) + " benchmark(s) slower than the baseline: " + ', '.join(slower))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -4,11 +4,15 @@
 # modified
 
 import ctypes
-import matplotlib.pyplot as plt
 from ctypes import *
-from picosdk.functions import adc2mV
 import numpy as np
 import multiprocessing as mp
+from multiprocessing import shared_memory
+import sys
+import time
+from functools import lru_cache
+import metrics
+from robustStats import windowMedian, trimmedStats, REGIME_RUN
 
 ### Constants ##############
 # definitions from ps2000Api.h:
@@ -17,6 +21,7 @@ PS2000_SINE = 0 # ps2000_set_sig_gen_built_in() wave type
 PS2000_CHANNEL_A = 0 # ps2000_set_channel() channel ID
 PS2000_CHANNEL_B = 1 # ps2000_set_channel() channel ID
 PS2000_NONE = 5 # ps2000_set_trigger() source
+PS2000_NS = 2 # ps2000_run_streaming_ns() time units
 
 #oscilloscope voltage ranges
 PS2000_VOLTAGE_RANGE = {
@@ -34,6 +39,8 @@ PS2000_VOLTAGE_RANGE = {
 
 NANO2MILI=1000000
 MAX_ADC=32767
+#full scale of the voltage ranges in mV (index = range code)
+PS2000_RANGE_MV=[10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000]
 NUM_SAMPLES=2000
 SIGNAL_AMPL=2000000  #peak to peak amplitude in uV
 SIGNAL_FREQ =1000
@@ -50,18 +57,182 @@ else:
 #how many data to save for averaging the results
 DATA_BUF=100
 
+#frequency sweep of the generator (DevControl sweep): default (start Hz, stop Hz, increment Hz, dwell s).
+#The steps are moved onto the FFT bins of a capture, and a capture is assigned to a step only if
+#at least SWEEP_PURITY of the sweep power on channel B is in that step (not across a step change)
+SWEEP=(100, 5000, 250, 0.25)
+SWEEP_PURITY=0.999
+
+#waiting for a block: after the indisposed time, poll ps2000_ready starting every POLL_MIN seconds,
+#doubling up to POLL_MAX, and give up after READY_TIMEOUT seconds (the block is started again, see blockDelays).
+#A stream that delivers no samples for READY_TIMEOUT seconds is restarted once, then given up
+POLL_MIN=0.0002
+POLL_MAX=0.005
+READY_TIMEOUT=5.0
+
+def pollDelays(timeIndisposedms):
+    '''sleep durations (s) between ps2000_ready polls: the driver's estimate first, then an exponential backoff'''
+    yield timeIndisposedms / 1000
+    delay = POLL_MIN
+    while True:
+        yield delay
+        delay = min(delay * 2, POLL_MAX)
+
+#opening a unit by serial number: attempts, and wait between them (s, grows with every attempt)
+OPEN_RETRIES=5
+OPEN_BACKOFF=0.5
+
+#auto-ranging: a channel goes one range up when its peak reaches RANGE_UP of the full scale (or it overflows),
+#and one range down after RANGE_HOLD captures whose peaks fit in RANGE_DOWN of the lower range.
+#An overflowed block is captured again (at most MAX_RECAPTURE times) at the new range
+RANGE_UP=0.95
+RANGE_DOWN=0.8
+RANGE_HOLD=10
+RANGE_MIN=PS2000_VOLTAGE_RANGE['PS2000_50MV']
+RANGE_MAX=PS2000_VOLTAGE_RANGE['PS2000_20V']
+MAX_RECAPTURE=3
+
+#streaming mode: samples kept in the ring buffer (per channel) and requested per driver callback
+STREAM_BUF=NUM_SAMPLES*64
+STREAM_OVERVIEW=NUM_SAMPLES*8
+
+#plot frames: samples per channel a frame can hold, and frames kept in shared memory
+FRAME_CAPACITY=STREAM_BUF
+FRAME_SLOTS=3
+
+# void GetOverviewBuffersMaxMin(int16_t **overviewBuffers, int16_t overflow, uint32_t triggeredAt,
+#                               int16_t triggered, int16_t auto_stop, uint32_t nValues)
+if sys.platform == 'win32':
+    GetOverviewBuffersType = WINFUNCTYPE(None, POINTER(POINTER(c_int16)), c_int16, c_uint32, c_int16, c_int16, c_uint32)
+else:
+    GetOverviewBuffersType = CFUNCTYPE(None, POINTER(POINTER(c_int16)), c_int16, c_uint32, c_int16, c_int16, c_uint32)
+
+class CaptureError(Exception):
+    '''the oscilloscope did not deliver a capture'''
+
+def loadDriver(name='PS2000', **options):
+    '''returns the driver object DevControl talks to:
+    'PS2000' loads the Pico DLL, 'simulated' a pure-Python simulated unit (options are passed to it)'''
+    if name == 'PS2000':
+        return ctypes.windll.LoadLibrary('PS2000')
+    elif name == 'simulated':
+        from simulatedPS2000 import SimulatedPS2000
+        return SimulatedPS2000(**options)
+    raise ValueError("Unknown driver: " + str(name))
+
+class windowStats:
+    '''running mean and variance of the last size values, kept in a circular buffer.
+    Adding a value is O(1): Welford's update, with the value it overwrites removed the same way'''
+    #the sums are recomputed from the window every RESYNC*size updates so rounding errors cannot build up
+    RESYNC=64
+
+    def __init__(self, size, fill=0.0):
+        self.size=size
+        self.values=np.full(size, fill, dtype=float)
+        self.count=0
+        self.pos=0
+        self.mean=0.0
+        self.m2=0.0
+        self.updates=0
+
+    def add(self, x):
+        x=float(x)
+        if self.count < self.size:
+            self.count=self.count + 1
+            delta=x - self.mean
+            self.mean=self.mean + delta / self.count
+            self.m2=self.m2 + delta * (x - self.mean)
+        else:
+            old=float(self.values[self.pos])
+            oldmean=self.mean
+            self.mean=oldmean + (x - old) / self.size
+            self.m2=max(self.m2 + (x - old) * (x - self.mean + old - oldmean), 0.0)
+        self.values[self.pos]=x
+        self.pos=(self.pos + 1) % self.size
+        self.updates=self.updates + 1
+        if self.updates >= self.RESYNC * self.size:
+            self.resync()
+
+    def resync(self):
+        window=self.values[:self.count]
+        self.mean=float(np.mean(window))
+        self.m2=float(np.sum((window - self.mean) ** 2))
+        self.updates=0
+
+    def std(self):
+        return np.sqrt(self.m2 / self.count) if self.count else 0.0
+
+@lru_cache(maxsize=16)
+def lockInReference(n, freq, dt):
+    '''cos and -sin references at freq for n samples every dt seconds, as (n, 2) matrix,
+    scaled so that the projection of a sine gives its RMS amplitude.
+    Only the largest whole number of periods is used, so DC and harmonics cancel out'''
+    periods = np.floor(n * freq * dt)
+    used = int(round(periods / (freq * dt))) if periods >= 1 else n
+    t = np.arange(n) * dt
+    window = (np.arange(n) < used) * (np.sqrt(2) / used)
+    return np.stack((window * np.cos(2 * np.pi * freq * t), -window * np.sin(2 * np.pi * freq * t)), axis=1)
+
+def lockIn(data, freq, dt):
+    '''lock-in (single DFT bin) estimate at freq along the last axis of data, sampled every dt seconds.
+    data can hold many captures, e.g. (captures, channels, samples).
+    Returns the RMS amplitude and the phase (rad) of the freq component: noise and harmonics are rejected'''
+    data = np.asarray(data)
+    iq = data @ lockInReference(data.shape[-1], freq, dt)
+    return np.hypot(iq[..., 0], iq[..., 1]), np.arctan2(iq[..., 1], iq[..., 0])
+
+def snapSweep(start, stop, increment, n, dt):
+    '''moves the sweep onto the FFT bins of n samples every dt seconds (multiples of 1/(n dt)),
+    so every step is read from a single bin without leakage. Returns start, stop and increment in Hz'''
+    df = 1 / (n * dt)
+    start = max(1, round(start / df)) * df
+    increment = max(1, round(increment / df)) * df
+    stop = start + np.floor((stop - start) / increment + 1e-9) * increment
+    return start, stop, increment
+
+def sweepFrequencies(start, stop, increment):
+    '''frequencies of the steps of an up sweep'''
+    return start + increment * np.arange(int(round((stop - start) / increment)) + 1)
+
+def binPhasors(data, freqs, dt):
+    '''complex RMS amplitudes at freqs (on FFT bins) along the last axis of data, one rfft per capture:
+    data (captures, channels, samples) gives (captures, channels, len(freqs)). Same phase as lockIn'''
+    n = data.shape[-1]
+    bins = np.rint(np.asarray(freqs) * n * dt).astype(np.intp)
+    return np.fft.rfft(data, axis=-1)[..., bins] * (np.sqrt(2) / n)
+
 ###Channel A is Ch1: measurement, voltage should be calculated from here
 ### Channel B is Ch2 : input, current should be calculated from here
 class dataBuff:
-    '''a class that stores an array of measurements: LIFO buffer'''
-    def __init__(self):
-        self.Vlist = np.zeros(DATA_BUF)
+    '''a class that stores the last size measurements in a circular buffer,
+    with running averages and standard deviations.
+    estimator: 'rms' uses the broadband RMS of every capture, 'lockin' only its SIGNAL_FREQ component
+    robust: captures far from the window median (see robustStats) are rejected,
+    and getStats leaves out the values far from the median
+    phase: also average the phase of every capture (one lock-in per capture): by default only with the
+    lock-in estimator, which computes it anyway'''
+    def __init__(self, size=DATA_BUF, estimator='rms', robust=False, phase=None):
+        self.size = size
+        self.estimator = estimator
+        self.phase = estimator == 'lockin' if phase is None else phase
+        self.robust = robust
+        self.V = windowStats(size, 0.0)
+        self.Vlist = self.V.values
         self.Vstd = 0
         self.Vavg=0
-        self.Ilist = np.ones(DATA_BUF)
+        self.I = windowStats(size, 1.0)
+        self.Ilist = self.I.values
         self.Istd = 0
         self.Iavg=0
+        # phase of channel A relative to channel B, in radians (not the phase of the current, see calculateCurrent)
+        self.P = windowStats(size, 0.0)
         self.num_samples=0
+        if robust:
+            self.Vmedian = windowMedian(size)
+            self.Imedian = windowMedian(size)
+        # captures rejected as outliers, and the last ones rejected in a row
+        self.rejected = 0
+        self.pending = []
 
     ## the current drawn from the function generator is:
     #  (output voltage-measured voltage)/output impedance
@@ -70,136 +241,668 @@ class dataBuff:
         Vout = ((SIGNAL_AMPL/2000) /(np.sqrt(2)))
         return ((Vout-chB)/OUTPUTIMP)
 
-    def addMeasurement(self, chA, chB):
-        '''adds the rms of the newest measurement to the buffer,
-        calculates average and standard deviation'''
-        #getting RMS
-        Arms = np.sqrt(np.mean(np.power(chA, 2)))
-        Brms = np.sqrt(np.mean(np.power(chB, 2)))
-
-        #if the buffer is not full yet:
-        if self.num_samples<DATA_BUF:
-            self.Vlist[self.num_samples]=Arms
-            self.Ilist[self.num_samples]=self.calculateCurrent(Brms)
-            self.num_samples = self.num_samples + 1
-        #if the buffer is already full, it works as a LIFO
+    def addMeasurement(self, chA, chB, dt=None):
+        '''adds the rms of the newest measurement to the buffer (overwriting the oldest one when full),
+        updates average and standard deviation.
+        dt: sample interval in seconds, needed for the phase and the lock-in estimator'''
+        self.addMeasurements(np.stack((chA, chB))[np.newaxis], dt)
+        return
+
+    def addMeasurements(self, captures, dt=None):
+        '''adds a batch of captures at once: captures is a (captures, 2, samples) array of channel A and B'''
+        if dt is None and self.estimator == 'lockin':
+            raise ValueError("the lock-in estimator needs the sample interval dt")
+        trackPhase = self.phase and dt is not None
+        if self.estimator == 'lockin' or trackPhase:
+            amplitude, phase = lockIn(captures, SIGNAL_FREQ, dt)
+            phase = np.angle(np.exp(1j * (phase[:, 0] - phase[:, 1])))
+        if self.estimator == 'lockin':
+            rms = amplitude
         else:
-            self.Vlist[0:-1]=self.Vlist[1:]
-            self.Vlist[-1]=Arms
-            self.Ilist[0:-1]=self.Ilist[1:]
-            self.Ilist[-1]=self.calculateCurrent(Brms)
-
-        self.Vavg=np.mean(self.Vlist[0:self.num_samples])
-        self.Vstd=np.std(self.Vlist[0:self.num_samples])
-        self.Istd=np.std(self.Ilist[0:self.num_samples])
-        self.Iavg=np.mean(self.Ilist[0:self.num_samples])
+            #getting RMS
+            rms = np.sqrt(np.mean(np.square(captures, dtype=np.float64), axis=-1))
+
+        for i in range(len(captures)):
+            values = (rms[i, 0], self.calculateCurrent(rms[i, 1]), phase[i] if trackPhase else None)
+            if self.robust:
+                if self.Vmedian.isOutlier(values[0]) or self.Imedian.isOutlier(values[1]):
+                    self.rejected = self.rejected + 1
+                    metrics.count('captures_rejected')
+                    self.pending.append(values)
+                    if len(self.pending) < REGIME_RUN:
+                        continue
+                    #so many outliers in a row: the level changed, the window follows it
+                    for values in self.pending:
+                        self.addValues(*values)
+                    self.pending = []
+                    continue
+                self.pending = []
+            self.addValues(*values)
+        self.num_samples = self.V.count
+
+        self.Vavg=self.V.mean
+        self.Vstd=self.V.std()
+        self.Istd=self.I.std()
+        self.Iavg=self.I.mean
         return
 
+    def addValues(self, V, I, phase=None):
+        '''adds the values of one capture to the window'''
+        self.V.add(V)
+        self.I.add(I)
+        if phase is not None:
+            self.P.add(phase)
+        if self.robust:
+            self.Vmedian.add(V)
+            self.Imedian.add(I)
+
     def getStats(self):
         # print("V avg:", self.stats.Vavg, "V diff: ", self.stats.Iavg)
         # Mean is in mV, std is in uV so it needs to be multiplied by 1000
+        if self.robust:
+            #trimmed: without the values far from the median (the first captures are never rejected)
+            Vavg, Vstd = trimmedStats(self.Vlist[:self.V.count])
+            Iavg, Istd = trimmedStats(self.Ilist[:self.I.count])
+            return Vavg, Vstd * 1000, Iavg, Istd * 1000
         return self.Vavg, self.Vstd * 1000, self.Iavg, self.Istd * 1000
 
+    def getPhase(self):
+        '''average and standard deviation of the phase of channel A relative to channel B, in degrees
+        (nan if the phase is not tracked)'''
+        if not self.P.count:
+            return np.nan, np.nan
+        return np.degrees(self.P.mean), np.degrees(self.P.std())
+
+class impedanceSpectrum:
+    '''impedance at every step of a generator sweep, from the same captures as dataBuff.
+    Every capture goes to the step dominating channel B (captures across a step change are skipped),
+    and every step keeps running stats of its last size values.
+    sweep: (start Hz, stop Hz, increment Hz, ...) as given to DevControl'''
+    calculateCurrent = dataBuff.calculateCurrent
+
+    def __init__(self, sweep=SWEEP, size=DATA_BUF):
+        self.sweep = sweep
+        self.size = size
+        self.freqs = None
+        self.key = None
+        self.skipped = 0
+
+    def setup(self, n, dt):
+        '''steps of the sweep for captures of n samples every dt seconds'''
+        self.key = (n, dt)
+        self.freqs = sweepFrequencies(*snapSweep(*self.sweep[:3], n, dt))
+        self.V = [windowStats(self.size, 0.0) for f in self.freqs]
+        self.I = [windowStats(self.size, 1.0) for f in self.freqs]
+        self.P = [windowStats(self.size, 0.0) for f in self.freqs]
+
+    def addMeasurements(self, captures, dt):
+        '''adds a batch of (captures, 2, samples) captures of channel A and B'''
+        captures = np.asarray(captures)
+        if self.key != (captures.shape[-1], dt):
+            self.setup(captures.shape[-1], dt)
+        phasors = binPhasors(captures, self.freqs, dt)
+        power = np.square(np.abs(phasors[:, 1]))
+        steps = np.argmax(power, axis=1)
+        for i, k in enumerate(steps):
+            if power[i, k] < SWEEP_PURITY * power[i].sum():
+                self.skipped = self.skipped + 1
+                continue
+            a, b = phasors[i, 0, k], phasors[i, 1, k]
+            self.V[k].add(abs(a))
+            self.I[k].add(self.calculateCurrent(abs(b)))
+            self.P[k].add(np.angle(a / b))
+
+    def addMeasurement(self, chA, chB, dt):
+        self.addMeasurements(np.stack((chA, chB))[np.newaxis], dt)
+
+    def getSpectrum(self):
+        '''frequencies (Hz), V mean (mV), V std (uV), I mean (mA), I std (uA), A-B phase (deg) and captures of every step,
+        as arrays (None before the first capture)'''
+        if self.freqs is None:
+            return None
+        return {'frequency': self.freqs.copy(),
+                'Vavg': np.array([v.mean for v in self.V]),
+                'Vstd': np.array([v.std() for v in self.V]) * 1000,
+                'Iavg': np.array([i.mean for i in self.I]),
+                'Istd': np.array([i.std() for i in self.I]) * 1000,
+                'phase': np.degrees([p.mean for p in self.P]),
+                'count': np.array([v.count for v in self.V])}
+
+class StreamRing:
+    '''pre-allocated ring of int16 samples for channel A and B, filled by the streaming callback.
+    Counters are absolute sample numbers, so consecutive windows are gapless
+    unless the reader falls more than the ring size behind (counted in lost)'''
+    def __init__(self, size=STREAM_BUF):
+        self.size=size
+        self.data=np.zeros((2, size), dtype=np.int16)
+        self.written=0
+        self.read=0
+        self.lost=0
+        self.overflow=0
+
+    def available(self):
+        return self.written-self.read
+
+    def write(self, chA, chB, n, overflow=0):
+        '''copies n new samples of both channels into the ring'''
+        if n > self.size: #only the newest samples fit
+            chA, chB = chA[n-self.size:], chB[n-self.size:]
+            self.written=self.written+n-self.size
+            n=self.size
+        start=self.written % self.size
+        first=min(n, self.size-start)
+        self.data[0, start:start+first]=chA[:first]
+        self.data[1, start:start+first]=chB[:first]
+        self.data[0, :n-first]=chA[first:n]
+        self.data[1, :n-first]=chB[first:n]
+        self.written=self.written+n
+        self.overflow=self.overflow | overflow
+        if self.written-self.read > self.size: #the reader was overrun
+            self.lost=self.lost+self.written-self.size-self.read
+            self.read=self.written-self.size
+
+    def readWindow(self, outA, outB, n):
+        '''copies the next n unread samples into outA and outB, returns the overflow flags seen since the last read'''
+        start=self.read % self.size
+        first=min(n, self.size-start)
+        outA[:first]=self.data[0, start:start+first]
+        outB[:first]=self.data[1, start:start+first]
+        outA[first:n]=self.data[0, :n-first]
+        outB[first:n]=self.data[1, :n-first]
+        self.read=self.read+n
+        overflow, self.overflow = self.overflow, 0
+        return overflow
+
+class FrameChannel:
+    '''latest-frame channel in shared memory: the producer writes (time, chA, chB) frames
+    round robin into FRAME_SLOTS slots without ever blocking, readers copy only the newest frame.
+    Every slot carries the sequence number of the frame in it, set to 0 while it is rewritten,
+    so a reader can tell when the slot it copied was overwritten in the meantime.'''
+    # header: latest sequence number, closed flag, number of slots, capacity, frames the reader skipped,
+    # then (sequence, length) of every slot
+    HEADER=5
+
+    def __init__(self, name=None, capacity=FRAME_CAPACITY, slots=FRAME_SLOTS):
+        '''creates the channel, or attaches to an existing one if name is given (its size is read from the header)'''
+        if name is None:
+            size=(self.HEADER + 2 * slots) * 8 + slots * 3 * capacity * 4
+            self.shm=shared_memory.SharedMemory(create=True, size=size)
+            self.owner=True
+            np.ndarray(self.HEADER, dtype=np.int64, buffer=self.shm.buf)[:]=(0, 0, slots, capacity, 0)
+        else:
+            self.shm=shared_memory.SharedMemory(name=name)
+            self.owner=False
+        self.name=self.shm.name
+        self.slots, self.capacity=(int(x) for x in np.ndarray(self.HEADER, dtype=np.int64, buffer=self.shm.buf)[2:4])
+        headerSize=(self.HEADER + 2 * self.slots) * 8
+        self.header=np.ndarray(self.HEADER + 2 * self.slots, dtype=np.int64, buffer=self.shm.buf)
+        self.slotSeq=self.header[self.HEADER::2]
+        self.slotLen=self.header[self.HEADER + 1::2]
+        self.data=np.ndarray((self.slots, 3, self.capacity), dtype=np.float32, buffer=self.shm.buf, offset=headerSize)
+        self.seq=0
+
+    def publish(self, time, chA, chB):
+        '''writes a frame into the next slot (frames longer than the capacity are truncated)'''
+        n=min(len(time), self.capacity)
+        self.seq=self.seq + 1
+        slot=self.seq % self.slots
+        self.slotSeq[slot]=0
+        self.data[slot, 0, :n]=time[:n]
+        self.data[slot, 1, :n]=chA[:n]
+        self.data[slot, 2, :n]=chB[:n]
+        self.slotLen[slot]=n
+        self.slotSeq[slot]=self.seq
+        self.header[0]=self.seq
+
+    def setDropped(self, dropped):
+        '''the reader reports how many frames it skipped'''
+        self.header[4]=dropped
+
+    def dropped(self):
+        return int(self.header[4])
+
+    def read(self, lastSeq=0):
+        '''returns (seq, time, chA, chB) copies of the newest frame, or None if there is nothing newer than lastSeq'''
+        seq=int(self.header[0])
+        while seq > lastSeq:
+            slot=seq % self.slots
+            n=int(self.slotLen[slot])
+            if self.slotSeq[slot] == seq:
+                frame=self.data[slot, :, :n].copy()
+                if self.slotSeq[slot] == seq: #not overwritten while copying
+                    return seq, frame[0], frame[1], frame[2]
+            seq=int(self.header[0]) #the producer moved on, retry with the newest frame
+        return None
+
+    def setClosed(self):
+        self.header[1]=1
+
+    def isClosed(self):
+        return self.header[1] != 0
+
+    def close(self):
+        self.header=self.slotSeq=self.slotLen=self.data=None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def decimateMinMax(time, data, width):
+    '''reduces data to width bins, keeping the min and max of every bin (2*width points, at the times of the
+    first and last sample of the bin), so peaks stay visible. The bins cover every sample: when width does not
+    divide the length, some bins hold one sample more. Short data is returned unchanged'''
+    if len(data) < 2 * width:
+        return time, data
+    edges = np.linspace(0, len(data), width + 1).astype(np.intp)
+    envelope = np.empty(2 * width, dtype=data.dtype)
+    envelope[0::2] = np.minimum.reduceat(data, edges[:-1])
+    envelope[1::2] = np.maximum.reduceat(data, edges[:-1])
+    envelopeTime = np.empty(2 * width, dtype=time.dtype)
+    envelopeTime[0::2] = time[edges[:-1]]
+    envelopeTime[1::2] = time[edges[1:] - 1]
+    return envelopeTime, envelope
+
+def pyplot():
+    '''matplotlib.pyplot, imported on first use: headless runs never load it'''
+    import matplotlib.pyplot as plt
+    return plt
+
 class ScopePlotter(object):
-    ''' class to plot the oscilloscope signals in real time'''
-    def __init__(self):
+    ''' class to plot the oscilloscope signals in real time.
+    The figure is created in the plotting process, matplotlib is not imported before'''
+    #margin around the data when the y axes are rescaled (mV)
+    MARGIN = 100
+
+    def createFigure(self):
         ''' initialize a figure with the two channels '''
-        self.f,self.a=plt.subplots(1,1)
+        self.plt = pyplot()
+        self.f,self.a=self.plt.subplots(1,1)
         self.f.suptitle("Scope plotter")
         self.aCurrent=self.a.twinx()
         self.a.set_xlabel('Time (ms)')
         self.a.set_ylabel('Voltage (mV)')
         self.aCurrent.set_ylabel('Current [mA]')
-        self.chA, = self.a.plot([], [], color='b', linestyle='--', label='Voltage (chA)')
-        self.chB, = self.aCurrent.plot([], [], color='y', linestyle='--', label='Current (chB)')
+        # the lines are drawn with blitting, on top of a cached background
+        self.chA, = self.a.plot([], [], color='b', linestyle='--', label='Voltage (chA)', animated=True)
+        self.chB, = self.aCurrent.plot([], [], color='y', linestyle='--', label='Current (chB)', animated=True)
         self.a.legend(loc='upper left')
         self.aCurrent.legend(loc='upper right')
+        self.background = None
+
+    def fitLimits(self, ax, low, high):
+        '''rescales ax only if the data left its limits or would fit in half of them.
+        Returns True if the limits changed'''
+        ymin, ymax = ax.get_ylim()
+        if low >= ymin and high <= ymax and (high - low) + 2 * self.MARGIN > (ymax - ymin) / 2:
+            return False
+        ax.set_ylim((low - self.MARGIN, high + self.MARGIN))
+        return True
 
     def updateData(self, time, dataA, dataB):
-        ''' plot data from channel A and B'''
+        ''' plot data from channel A and B, decimated to the width of the axes.
+        Returns True if the axes changed and the whole figure has to be redrawn'''
+        width = max(int(self.a.bbox.width), 1)
+        tDec, dataA = decimateMinMax(time, dataA, width)
+        tDec, dataB = decimateMinMax(time, dataB, width)
 
-        self.chA.set_xdata(time)
-        self.chB.set_xdata(time)
-        self.chA.set_ydata(dataA)
-        self.chB.set_ydata(dataB)
+        self.chA.set_data(tDec, dataA)
+        self.chB.set_data(tDec, dataB)
 
-        self.a.set_ylim((min(dataA)-100, max(dataA)+100))
-        self.aCurrent.set_ylim((min(dataB)-100, max(dataB)+100))
-        self.a.set_xlim(time[0], time[-1])
-        return
+        rescaled = self.fitLimits(self.a, dataA.min(), dataA.max())
+        rescaled = self.fitLimits(self.aCurrent, dataB.min(), dataB.max()) or rescaled
+        if self.a.get_xlim() != (tDec[0], tDec[-1]):
+            self.a.set_xlim(tDec[0], tDec[-1])
+            rescaled = True
+        return rescaled
+
+    def onDraw(self, event):
+        '''after a full redraw (rescale, resize): cache the background and draw the lines on it'''
+        self.background = self.f.canvas.copy_from_bbox(self.f.bbox)
+        self.a.draw_artist(self.chA)
+        self.aCurrent.draw_artist(self.chB)
+
+    def blit(self):
+        '''redraws only the lines'''
+        self.f.canvas.restore_region(self.background)
+        self.a.draw_artist(self.chA)
+        self.aCurrent.draw_artist(self.chB)
+        self.f.canvas.blit(self.f.bbox)
 
     def terminate(self):
-        plt.close('all')
+        self.plt.close('all')
 
     def call_back(self):
-        '''called at every update '''
-        while self.pipe.poll():
-            command = self.pipe.recv()
-            if command is None:
-                self.terminate()
-                return False
+        '''called at every update: draws only the newest frame, older ones are dropped'''
+        if self.channel.isClosed():
+            self.terminate()
+            self.channel.close()
+            return False
+        frame = self.channel.read(self.lastSeq)
+        if frame is not None:
+            seq, time, dataA, dataB = frame
+            if seq - self.lastSeq > 1:
+                self.dropped = self.dropped + seq - self.lastSeq - 1
+                self.channel.setDropped(self.dropped)
+            self.lastSeq = seq
+            if self.updateData(time, dataA, dataB) or self.background is None:
+                self.f.canvas.draw()
             else:
-                self.updateData(command['time'],command['chA'], command['chB'])
-        self.f.canvas.draw()
+                self.blit()
         return True
 
-    def __call__(self, pipe):
+    def __call__(self, channelName):
         ''' starting point'''
         print('starting plotter...')
-        self.pipe = pipe
+        self.createFigure()
+        self.channel = FrameChannel(channelName)
+        self.lastSeq = 0
+        self.dropped = 0
+        self.f.canvas.mpl_connect('draw_event', self.onDraw)
         timer = self.f.canvas.new_timer(interval=100)
         timer.add_callback(self.call_back)
         timer.start()
         print('...done')
-        plt.show()
+        self.plt.show()
 
 class MultiprocConnector(object):
+    '''sends the captures to the plotting process through a shared memory FrameChannel'''
     def __init__(self):
         print ('multiproc created')
-        self.plot_pipe, plotter_pipe = mp.Pipe()
+        self.channel = FrameChannel()
         self.plotter = ScopePlotter()
         self.plot_process = mp.Process(
-            target=self.plotter, args=(plotter_pipe,), daemon=True)
+            target=self.plotter, args=(self.channel.name,), daemon=True)
         self.plot_process.start()
+        metrics.watch('plot_frames_dropped', self.channel.dropped)
+
+    def sendFinished(self):
+        self.channel.setClosed()
+        self.plot_process.join(timeout=1)
+        #the metrics are exported again after the channel is gone: they keep its last count
+        dropped = self.channel.dropped()
+        metrics.watch('plot_frames_dropped', lambda: dropped)
+        self.channel.close()
+
+    def updateData(self, time, ChA, ChB):
+        '''never blocks: if the plotter is behind, it skips to the newest frame'''
+        with metrics.span('plot_send'):
+            self.channel.publish(time, ChA, ChB)
+
+class HeadlessConnector(object):
+    '''same interface as MultiprocConnector for unattended runs: no plotting process, the captures are not shown'''
+    def __init__(self):
+        print ('headless: no plot')
 
     def sendFinished(self):
-        self.plot_pipe.send(None)
+        pass
 
     def updateData(self, time, ChA, ChB):
-        data = {'chA': ChA, 'chB': ChB, 'time': time}
-        self.plot_pipe.send(data)
+        pass
+
+class CaptureConfig:
+    '''capture settings of a unit: timebase, number of samples and the range of every channel.
+    The ps2000_get_timebase answer is memoized per (timebase, samples), and with autoRange
+    the ranges follow the peaks of the recent captures'''
+    def __init__(self, timebase=11, samples=NUM_SAMPLES, ranges=None, autoRange=False):
+        self.timebase=timebase
+        self.samples=samples
+        self.ranges=dict(ranges) if ranges is not None else {'A': voltrange, 'B': voltrange}
+        self.autoRange=autoRange
+        self.timebases={}
+        #consecutive captures that would fit in the lower range, per channel
+        self.below={name: 0 for name in self.ranges}
+
+    def getTimebase(self, picoObj, device):
+        '''returns (status, interval, time units, max samples) of the current timebase, asking the driver only once'''
+        key=(self.timebase, self.samples)
+        if key not in self.timebases:
+            timeInterval = ctypes.c_int32()
+            timeUnits = ctypes.c_int32()
+            maxSamplesReturn = ctypes.c_int32()
+            with metrics.span('get_timebase'):
+                status = picoObj.ps2000_get_timebase(device, c_short(self.timebase), self.samples, ctypes.byref(timeInterval),
+                                                     ctypes.byref(timeUnits), ctypes.c_int16(1), ctypes.byref(maxSamplesReturn))
+            if status == 0:
+                return status, timeInterval.value, timeUnits.value, maxSamplesReturn.value #not memoized, asked again next time
+            self.timebases[key]=(status, timeInterval.value, timeUnits.value, maxSamplesReturn.value)
+        return self.timebases[key]
+
+    def scale(self, name):
+        '''mV per ADC count of a channel'''
+        return PS2000_RANGE_MV[self.ranges[name]] / MAX_ADC
+
+    def checkRange(self, name, raw, overflowed):
+        '''returns the range the channel should use after a capture with the ADC counts raw'''
+        current=self.ranges[name]
+        peak=max(int(raw.max()), -int(raw.min()))
+        if (overflowed or peak >= RANGE_UP * MAX_ADC) and current < RANGE_MAX:
+            self.below[name]=0
+            return current + 1
+        if current > RANGE_MIN and peak * PS2000_RANGE_MV[current] < RANGE_DOWN * MAX_ADC * PS2000_RANGE_MV[current - 1]:
+            self.below[name]=self.below[name] + 1
+            if self.below[name] >= RANGE_HOLD:
+                self.below[name]=0
+                return current - 1
+        else:
+            self.below[name]=0
+        return current
 
 class DevControl:
     '''device control class '''
-    def __init__(self, A_state='on', B_state='on'):
+    def __init__(self, A_state='on', B_state='on', driver='PS2000', mode='block', serial=None, autoRange=False,
+                 sweep=None, **driver_options):
+        ''' driver: name passed to loadDriver, or an already loaded driver object
+        mode: 'block' re-arms a block capture for every window, 'streaming' streams continuously into a ring buffer
+        serial: serial number of the unit to open (as printed at start up), by default the first free unit
+        autoRange: adapt the voltage range of the channels to the signal (see CaptureConfig)
+        sweep: (start Hz, stop Hz, increment Hz, dwell s) to sweep the generator instead of SIGNAL_FREQ (see SWEEP)'''
         print('device control created')
+        self.mode = mode
+        self.sweep = sweep
+        self.config = CaptureConfig(autoRange=autoRange)
+        self.ranges = self.config.ranges
+        self.captureRanges = dict(self.ranges) #ranges of the last capture (autoRange may have changed ranges since)
+        self.states = {'A': A_state, 'B': B_state}
+        self.timeInterval = ctypes.c_int32()
 
-        self.picoObj = ctypes.windll.LoadLibrary('PS2000')
-        self.device = self.picoObj.ps2000_open_unit()
-        p = create_string_buffer(100)
+        if isinstance(driver, str):
+            self.picoObj = loadDriver(driver, **driver_options)
+        else:
+            self.picoObj = driver
+        self.device, serial_no, status = self.openUnit(serial)
 
-        status = self.picoObj.ps2000_get_unit_info(self.device, p, 100,PS2000_BATCH_AND_SERIAL)
         if status == 0:
             print("Failed to get unit info.\n")
             exit(0)
         else:
-            serial_no = p.value.decode()
+            self.serial = serial_no
             print("Device serial no (" + str(status) + ' chars reported): "' + str(serial_no)
                   + '" (' + str(len(serial_no)) + ' chars found).\n')
             self.startDevice(A_state, B_state)
 
+    def openUnit(self, serial=None, retries=OPEN_RETRIES):
+        '''opens the next free unit, or the one with the given serial number: the other units opened
+        while looking for it are closed again. As other processes may hold units for a moment
+        while they look for theirs, the search is retried a few times.
+        Returns the handle, the serial number and the ps2000_get_unit_info status'''
+        p = create_string_buffer(100)
+        for attempt in range(retries):
+            skipped = []
+            while True:
+                device = self.picoObj.ps2000_open_unit()
+                if device <= 0: #no more free units
+                    status = 0
+                    break
+                status = self.picoObj.ps2000_get_unit_info(device, p, 100,PS2000_BATCH_AND_SERIAL)
+                if serial is None or p.value.decode() == serial:
+                    break
+                skipped.append(device)
+            for other in skipped:
+                self.picoObj.ps2000_close_unit(other)
+            if device > 0 or serial is None:
+                break
+            print("Unit " + serial + " not found, retrying...\n")
+            time.sleep(OPEN_BACKOFF * (attempt + 1))
+        return device, p.value.decode(), status
+
     def startDevice(self, A_state='on', B_state='on'):
-        self.initSignalGen()
+        self.initSignalGen(self.sweep)
         self.setCh('A', A_state)
         self.setCh('B', B_state)
+        self.allocBuffers(self.config.samples)
+        if self.mode == 'streaming':
+            self.startStreaming()
 
     def getData(self):
-        self.getBlock()
-        #wave values
-        self.bufA, self.bufB, self.time = self.retrieveCh()
+        '''returns the time axis (ms) and channel A and B (mV) of the next capture.
+        The arrays are reused by the next capture: copy them if they have to be kept'''
+        for delay in self.captureDelays():
+            time.sleep(delay)
         return self.time, self.bufA, self.bufB
 
+    def captureDelays(self):
+        '''yields the sleep durations (s) until the next capture is in bufA, bufB and time (getData and acquire).
+        An overflowed block is captured again (at most MAX_RECAPTURE times) when autoRange raised a range'''
+        if self.mode == 'streaming':
+            with metrics.span('stream_wait'):
+                yield from self.streamDelays()
+            self.bufA, self.bufB, self.time = self.readStreamWindow()
+            self.autoRange()
+            return
+        for attempt in range(MAX_RECAPTURE + 1):
+            with metrics.span('ready'):
+                yield from self.blockDelays()
+            #wave values
+            self.bufA, self.bufB, self.time = self.retrieveCh()
+            if not self.autoRange(): #captured again if it overflowed and the range changed
+                break
+
+    @property
+    def timebase(self):
+        return self.config.timebase
+
+    @timebase.setter
+    def timebase(self, timebase):
+        self.config.timebase = timebase
+
+    def autoRange(self):
+        '''adapts the channel ranges to the last capture (if auto-ranging is on).
+        Returns True if the capture overflowed and a range was raised, i.e. it is worth capturing again'''
+        if not self.config.autoRange:
+            return False
+        changed = False
+        for name, raw, bit in (('A', self.rawA, 1), ('B', self.rawB, 2)):
+            newRange = self.config.checkRange(name, raw, self.overflowFlags & bit)
+            if newRange != self.ranges[name]:
+                self.ranges[name] = newRange
+                changed = True
+        if not changed:
+            return False
+        metrics.count('range_changes')
+        if self.mode == 'streaming': #the samples in the ring were taken at the old range
+            self.picoObj.ps2000_stop(self.device)
+        self.setCh('A', self.states['A'])
+        self.setCh('B', self.states['B'])
+        if self.mode == 'streaming':
+            self.startStreaming()
+        return self.overflowFlags != 0
+
+    def startStreaming(self):
+        '''starts continuous streaming with the same sample interval as block mode'''
+        status, self.timeInterval.value, timeUnits, maxSamples = self.config.getTimebase(self.picoObj, self.device)
+        if status == 0:
+            print("Failed to get timebase.\n")
+
+        self.ring = StreamRing(STREAM_BUF)
+        # the driver only holds a pointer to the callback, keep a reference to it
+        self.streamCallback = GetOverviewBuffersType(self.onStreamValues)
+        status = self.picoObj.ps2000_run_streaming_ns(
+            self.device,
+            c_uint32(self.timeInterval.value), # sample interval
+            PS2000_NS,
+            c_uint32(STREAM_BUF), # max samples
+            0, # auto_stop off: stream until ps2000_stop
+            c_uint32(1), # no aggregation
+            c_uint32(STREAM_OVERVIEW))
+        if status == 0:
+            print("Failed to start streaming.\n")
+        else:
+            print("Streaming started: " + str(self.timeInterval.value) + " ns per sample.\n")
+
+    def onStreamValues(self, overviewBuffers, overflow, triggeredAt, triggered, auto_stop, nValues):
+        '''driver callback: overviewBuffers holds the max/min buffers of A and B, the max ones are the raw values'''
+        if nValues == 0:
+            return
+        chA = np.ctypeslib.as_array(overviewBuffers[0], shape=(nValues,))
+        chB = np.ctypeslib.as_array(overviewBuffers[2], shape=(nValues,))
+        self.ring.write(chA, chB, nValues, overflow)
+
+    def getStreamWindow(self):
+        '''returns the next NUM_SAMPLES consecutive samples of the stream, converted like retrieveCh'''
+        with metrics.span('stream_wait'):
+            for delay in self.streamDelays():
+                time.sleep(delay)
+        return self.readStreamWindow()
+
+    def streamDelays(self):
+        '''sleep durations (s) while the next window of the stream fills up: after every poll of the driver,
+        the time the missing samples take to be sampled, so waiting costs no CPU.
+        A stream delivering nothing for READY_TIMEOUT s is restarted once, then CaptureError is raised'''
+        interval = self.timeInterval.value / 1e9
+        restarted = False
+        written = self.ring.written
+        lastNew = time.perf_counter()
+        while True:
+            self.picoObj.ps2000_get_streaming_last_values(self.device, self.streamCallback)
+            missing = self.numSamples - self.ring.available()
+            if missing <= 0:
+                return
+            if self.ring.written != written:
+                written = self.ring.written
+                lastNew = time.perf_counter()
+            elif time.perf_counter() - lastNew > READY_TIMEOUT:
+                if restarted:
+                    raise CaptureError("No samples streamed for " + str(READY_TIMEOUT) + " s")
+                print("Stream stalled, restarting it.\n")
+                metrics.count('stream_restarts')
+                self.picoObj.ps2000_stop(self.device)
+                self.startStreaming()
+                restarted = True
+                written = self.ring.written
+                lastNew = time.perf_counter()
+                continue
+            yield max(missing * interval, POLL_MIN)
+
+    def readStreamWindow(self):
+        lost = self.ring.lost
+        overflow = self.ring.readWindow(self.rawA, self.rawB, self.numSamples)
+        if lost:
+            print("Stream ring overrun: " + str(lost) + " samples lost.\n")
+            metrics.count('stream_samples_lost', lost)
+            self.ring.lost = 0
+        if overflow != 0:
+            print("Some buffers overflowed: code " + str(overflow) + ".\n")
+            metrics.count('overflows')
+        self.overflowFlags = overflow
+        self.captureTime = time.time()
+
+        with metrics.span('adc2mV'):
+            self.convertCh()
+        return self.mVA, self.mVB, self.getTimeAxis()
+
+    def pause(self):
+        '''idles the unit between bursts of captures: streaming is stopped
+        (in block mode nothing runs between two getData calls)'''
+        if self.mode == 'streaming':
+            self.picoObj.ps2000_stop(self.device)
+
+    def resume(self):
+        '''restarts after pause: a new stream, so the first window holds no stale samples'''
+        if self.mode == 'streaming':
+            self.startStreaming()
+
     def closeDevice(self):
+        if self.mode == 'streaming':
+            self.picoObj.ps2000_stop(self.device)
         status = self.picoObj.ps2000_close_unit(self.device)
 
         if status == 0:
@@ -207,15 +910,28 @@ class DevControl:
         else:
             print("Unit closed\n")
 
-    def initSignalGen(self):# generate a +/- 1 V sine wave
+    def initSignalGen(self, sweep=None):# generate a +/- 1 V sine wave
+        '''sweep: (start Hz, stop Hz, increment Hz, dwell s), steps up through the frequencies (moved onto
+        the FFT bins of a capture, see snapSweep), otherwise a fixed SIGNAL_FREQ sine'''
         sg_offset = c_long(0) # offset voltage in microvolts
         sg_pktopk = c_ulong(SIGNAL_AMPL) # peak to peak amplitude in microvolts
         sg_wavetype = PS2000_SINE
-        sg_startfreq = c_float(SIGNAL_FREQ) # assuming it's in hertz
-        sg_stopfreq = c_float(SIGNAL_FREQ)
-        sg_increment = c_float(0) # shouldn't matter if not sweeping
-        sg_dwell = c_float(0)
-        sg_sweeptype = 0
+        if sweep is None:
+            sg_startfreq = c_float(SIGNAL_FREQ) # assuming it's in hertz
+            sg_stopfreq = c_float(SIGNAL_FREQ)
+            sg_increment = c_float(0) # shouldn't matter if not sweeping
+            sg_dwell = c_float(0)
+        else:
+            status, interval, timeUnits, maxSamples = self.config.getTimebase(self.picoObj, self.device)
+            dt = interval / 1e9
+            start, stop, increment = snapSweep(sweep[0], sweep[1], sweep[2], self.config.samples, dt)
+            if sweep[3] < 2 * self.config.samples * dt:
+                print("Sweep dwell shorter than two captures: most captures will be skipped.\n")
+            sg_startfreq = c_float(start)
+            sg_stopfreq = c_float(stop)
+            sg_increment = c_float(increment)
+            sg_dwell = c_float(sweep[3]) # seconds per step
+        sg_sweeptype = 0 # up
         sg_sweeps = c_ulong(0)
 
         status = self.picoObj.ps2000_set_sig_gen_built_in(
@@ -234,22 +950,26 @@ class DevControl:
 
         if status == 0:
             print("Failed to set up sig. gen.\n")
+        elif sweep is not None:
+            print("Sig. gen. sweeping {:g} to {:g} Hz in steps of {:g} Hz.\n".format(
+                sg_startfreq.value, sg_stopfreq.value, sg_increment.value))
         else:
             print("Sig. gen. running.\n")
 
     def setCh(self, name, state):
         ch=PS2000_CHANNEL_A if name=='A' else PS2000_CHANNEL_B
         enable=1 if state=='on' else 0
+        mV=PS2000_RANGE_MV[self.ranges[name]]
 
         status = self.picoObj.ps2000_set_channel(
             self.device, ch,
             enable,  # 1 = enabled
             1,  # 1 = DC, 0 = AC
-            voltrange)
+            self.ranges[name])
         if status == 0:
             print("Failed to set up channel "+name+".\n")
         else:
-            print("Channel "+name+" set to +/-2 V DC.\n")
+            print("Channel "+name+" set to +/-" + ("{:g} V".format(mV/1000) if mV >= 1000 else str(mV) + " mV") + " DC.\n")
         return
 
     def setTrigger(self):
@@ -267,59 +987,109 @@ class DevControl:
             print("Trigger set to 'none'.\n")
 
     def getBlock(self):
+        with metrics.span('ready'):
+            for delay in self.blockDelays():
+                time.sleep(delay)
+        return
+
+    async def acquire(self):
+        '''coroutine version of getData: waits for the capture on the event loop
+        so other tasks (log parsing, CSV writing) run in the meantime'''
+        import asyncio #only the event loop users pay for importing it
+        for delay in self.captureDelays():
+            await asyncio.sleep(delay)
+        return self.time, self.bufA, self.bufB
+
+    def startBlock(self):
         # Let's say we want to capture one cycle of our 1 kHz signal with 1000 samples.
         # So we want 1000 samples in 1 ms.
-        no_of_samples = c_long(NUM_SAMPLES)
+        no_of_samples = c_long(self.numSamples)
         # That's 1 us per sample, or 1 MS/s.
         # Scope's max. sampling rate is 100 MS/s.
         # Therefore we want 1/100 of max. sampling rate.
         # Timebases go in multiples of 2, so nearest is 1/128 of 100 MS/s = 0.78125 MS/s.
         # 1/128 is timebase 7.
-        timebase = c_short(11)
-        self.timeInterval = ctypes.c_int32()
-        timeUnits = ctypes.c_int32()
-        oversample = ctypes.c_int16(1)
-        maxSamplesReturn = ctypes.c_int32()
+        timebase = c_short(self.timebase)
         timeIndisposedms = ctypes.c_int32()
-        status = self.picoObj.ps2000_get_timebase(self.device, timebase, no_of_samples.value, ctypes.byref(self.timeInterval), ctypes.byref(timeUnits),
-                                 oversample, ctypes.byref(maxSamplesReturn))
+        # the timebase does not change between captures: the driver is asked only once
+        status, self.timeInterval.value, timeUnits, maxSamples = self.config.getTimebase(self.picoObj, self.device)
         if status == 0:
             print("Failed to get timebase.\n")
         # Expect return value:
-        status = self.picoObj.ps2000_run_block(
-            self.device,
-            no_of_samples,
-            timebase,
-            1,  # oversample, not used
-            byref(timeIndisposedms)
-        )
+        with metrics.span('run_block'):
+            status = self.picoObj.ps2000_run_block(
+                self.device,
+                no_of_samples,
+                timebase,
+                1,  # oversample, not used
+                byref(timeIndisposedms)
+            )
 
         if status == 0:
             print("Failed to start block mode.\n")
         #else:
         #    print("Block mode started: see you in " + str(timeIndisposedms.value) + " ms.\n")
+        self.timeIndisposedms = timeIndisposedms.value
+        return
 
-        status = 0  # intialise to 'not ready'
+    def blockDelays(self):
+        '''starts a block and yields the sleep durations (s) until it is ready: the indisposed time reported
+        by ps2000_run_block, then a backoff instead of spinning on ps2000_ready.
+        A block that fails or times out is started again (MAX_RECAPTURE times), then CaptureError is raised,
+        so an unfinished block is never read'''
+        for attempt in range(MAX_RECAPTURE + 1):
+            self.startBlock()
+            deadline = time.perf_counter() + self.timeIndisposedms / 1000 + READY_TIMEOUT
+            for delay in pollDelays(self.timeIndisposedms):
+                yield delay
+                status = self.picoObj.ps2000_ready(self.device) # wait until finished or failed
+                if status != 0 or time.perf_counter() > deadline:
+                    break
+            if status > 0:
+                return
+            error = "USB transfer failed" if status < 0 else "Timed out waiting for the block"
+            print(error + (", capturing again.\n" if attempt < MAX_RECAPTURE else ".\n"))
+            metrics.count('capture_failures')
+        raise CaptureError(error)
 
-        while status == 0:  # wait until finished or failed
-            status = self.picoObj.ps2000_ready(self.device)
+    def allocBuffers(self, n):
+        '''allocates the capture buffers once per configuration: ctypes arrays the driver writes into,
+        int16 numpy views of them and the float32 mV outputs'''
+        self.numSamples = n
+        self.config.samples = n
+        self.bufferA = (ctypes.c_int16 * n)()
+        self.bufferB = (ctypes.c_int16 * n)()
+        self.rawA = np.frombuffer(self.bufferA, dtype=np.int16)
+        self.rawB = np.frombuffer(self.bufferB, dtype=np.int16)
+        self.mVA = np.empty(n, dtype=np.float32)
+        self.mVB = np.empty(n, dtype=np.float32)
+        self.overflow = c_long()
+        self.timeKey = None
 
-        if status < 0:
-            print("USB transfer failed.\n")
-        #else:
-        #    print("Data captured.\n")
-        return
+    def convertCh(self):
+        '''converts the ADC counts to mV in place, at the ranges the capture was taken with'''
+        self.captureRanges = dict(self.ranges)
+        np.multiply(self.rawA, np.float32(self.config.scale('A')), out=self.mVA)
+        np.multiply(self.rawB, np.float32(self.config.scale('B')), out=self.mVB)
+
+    def getTimeAxis(self):
+        '''time axis in ms, rebuilt only when the sample interval or the number of samples changes'''
+        key = (self.timeInterval.value, self.numSamples)
+        if key != self.timeKey:
+            self.timeAxis = np.linspace(0, self.numSamples * self.timeInterval.value, self.numSamples)/NANO2MILI
+            self.timeKey = key
+        return self.timeAxis
 
     def retrieveCh(self):
-        # Create buffers ready for data
-        bufferA = (ctypes.c_int16 * NUM_SAMPLES)()
-        bufferB = (ctypes.c_int16 * NUM_SAMPLES)()
-        overflow = c_long()
-        cmaxSamples = ctypes.c_int32(NUM_SAMPLES)
-        status = self.picoObj.ps2000_get_values(self.device, ctypes.byref(bufferA), ctypes.byref(bufferB), None, None,
-                                                   ctypes.byref(overflow), cmaxSamples)
-        if overflow.value != 0:
-            print("Some buffers overflowed: code " + str(overflow.value) + ".\n")
+        cmaxSamples = ctypes.c_int32(self.numSamples)
+        with metrics.span('get_values'):
+            status = self.picoObj.ps2000_get_values(self.device, ctypes.byref(self.bufferA), ctypes.byref(self.bufferB), None, None,
+                                                       ctypes.byref(self.overflow), cmaxSamples)
+        if self.overflow.value != 0:
+            print("Some buffers overflowed: code " + str(self.overflow.value) + ".\n")
+            metrics.count('overflows')
+        self.overflowFlags = self.overflow.value
+        self.captureTime = time.time()
 
         if status == 0:
             print("Failed to get values.\n")
@@ -327,14 +1097,8 @@ class DevControl:
         #    print (".")
             #print("Got " + str(status) + " values.\n")
 
-        # find maximum ADC count value
-        maxADC = ctypes.c_int16(MAX_ADC)
-
         # convert ADC counts data to mV
-        adc2mVChA = adc2mV(bufferA, voltrange, maxADC)
-        adc2mVChB = adc2mV(bufferB, voltrange, maxADC)
-
-        # Create time data
-        time = np.linspace(0, (cmaxSamples.value) * self.timeInterval.value, cmaxSamples.value)/NANO2MILI
-        return adc2mVChA, adc2mVChB, time
+        with metrics.span('adc2mV'):
+            self.convertCh()
+        return self.mVA, self.mVB, self.getTimeAxis()
 
@@ -0,0 +1,166 @@
+
+# Incremental reader of the IVS (InVitroApp) log: only the bytes appended since the last call are searched,
+# so looking up the latest values costs the same whatever the size of the log.
+
+import os
+from datetime import datetime
+
+# field -> (text marking the line, function extracting the value from that line)
+IVS_FIELDS = {
+    'concentration': ('Current concentration',
+                      lambda line: float(line.split('Current concentration')[1].split('\n')[0])),
+    'volume': ('Current volume',
+               lambda line: float(line.split('Current volume')[1].split('\n')[0])),
+    'temperature': ('Temperature step function',
+                    lambda line: float(line.split('to ')[1].split('degrees')[0])),
+    'theoretical_conc': ('Concentration step change to ',
+                         lambda line: float(line.split('Concentration step change to ')[1].split(' in')[0])),
+}
+#every line starts with its timestamp: "dd/mm/YYYY HH:MM [..."
+TIME_FORMAT = '%d/%m/%Y %H:%M'
+#bytes at the start of the log compared between two calls: a log recreated on the same inode starts differently
+FINGERPRINT = 256
+
+def parseTime(line):
+    '''timestamp of a log line, None if it has none'''
+    try:
+        return datetime.strptime(line.split(' [')[0], TIME_FORMAT)
+    except ValueError:
+        return None
+
+def parseLine(key, line):
+    '''returns (value, timestamp) of a log line, None for the parts that cannot be read'''
+    try:
+        value = IVS_FIELDS[key][1](line)
+    except (IndexError, ValueError):
+        value = None
+    return value, parseTime(line)
+
+class LogTailer:
+    '''keeps the latest value of every IVS_FIELDS field of a growing log file.
+    The file is searched backwards from its end, and later only from the offset reached before,
+    so the latest values are found without reading the whole log.
+    A truncated or replaced (rotated) file is searched again from its start, and so is a file whose first
+    FINGERPRINT bytes changed (recreated on the same inode); values found before are kept until the new file
+    reports newer ones.'''
+    BLOCK = 1 << 20
+
+    def __init__(self, path, encoding='utf8'):
+        self.path = path
+        self.encoding = encoding
+        self.markers = {key: marker.encode(encoding) for key, (marker, parser) in IVS_FIELDS.items()}
+        self.fileId = None
+        self.head = b'' #first bytes of the file, up to FINGERPRINT
+        self.offset = 0 #start of the first line not searched yet
+        self.fields = {} #field -> (value, timestamp, line) from complete lines
+        self.pending = {} #same, from an unterminated last line (may still be growing)
+
+    def findLast(self, data, found):
+        '''records the last line of data containing each marker not found yet'''
+        for key, marker in self.markers.items():
+            if key in found:
+                continue
+            i = data.rfind(marker)
+            if i >= 0:
+                start = data.rfind(b'\n', 0, i) + 1
+                end = data.find(b'\n', i)
+                found[key] = data[start:end if end >= 0 else len(data)]
+
+    def scanBackwards(self, f, lo, hi):
+        '''finds the last line of every field between lo and hi (both at line starts), reading from the end'''
+        found = {}
+        carry = b'' #beginning of the line cut at the start of the previous block
+        pos = hi
+        while pos > lo and len(found) < len(self.markers):
+            start = max(lo, pos - self.BLOCK)
+            f.seek(start)
+            data = f.read(pos - start) + carry
+            pos = start
+            if start > lo:
+                nl = data.find(b'\n')
+                if nl < 0: #the line is longer than a block
+                    carry = data
+                    continue
+                carry, data = data[:nl + 1], data[nl + 1:]
+            self.findLast(data, found)
+        return found
+
+    def lastLineStart(self, f, size):
+        '''position after the last newline of the file (not before self.offset)'''
+        pos = size
+        while pos > self.offset:
+            start = max(self.offset, pos - self.BLOCK)
+            f.seek(start)
+            nl = f.read(pos - start).rfind(b'\n')
+            if nl >= 0:
+                return start + nl + 1
+            pos = start
+        return self.offset
+
+    def decode(self, found):
+        return {key: parseLine(key, line.decode(self.encoding, errors='replace').rstrip('\r\n')) + (line,)
+                for key, line in found.items()}
+
+    def update(self):
+        '''searches the bytes appended since the last call'''
+        st = os.stat(self.path)
+        fileId = (st.st_dev, st.st_ino)
+        with open(self.path, 'rb') as f:
+            head = f.read(FINGERPRINT)
+            #rotated, truncated, or recreated (on the same inode, possibly already longer than the offset)
+            if fileId != self.fileId or st.st_size < self.offset or head[:len(self.head)] != self.head:
+                self.fileId = fileId
+                self.offset = 0
+                self.pending = {}
+            self.head = head
+            if st.st_size == self.offset:
+                return
+            end = self.lastLineStart(f, st.st_size)
+            self.fields.update(self.decode(self.scanBackwards(f, self.offset, end)))
+            f.seek(end)
+            partial = f.read(st.st_size - end)
+        pending = {}
+        self.findLast(partial, pending)
+        self.pending = self.decode(pending)
+        self.offset = end
+
+    def timeAt(self, f, pos):
+        '''(start, timestamp) of the first line with a timestamp starting at or after pos, (end of file, None) if none'''
+        f.seek(max(pos - 1, 0))
+        if pos > 0:
+            f.readline() #to the first line starting at or after pos
+        while True:
+            start = f.tell()
+            line = f.readline()
+            if not line:
+                return start, None
+            timestamp = parseTime(line.decode(self.encoding, errors='replace'))
+            if timestamp is not None:
+                return start, timestamp
+
+    def offsetAfter(self, f, when, size):
+        '''start of the first line logged after when: binary search on the file, whose lines are in time order'''
+        lo, hi = 0, size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            timestamp = self.timeAt(f, mid)[1]
+            if timestamp is None or timestamp > when:
+                hi = mid
+            else:
+                lo = mid + 1
+        return self.timeAt(f, lo)[0]
+
+    def valuesAt(self, when):
+        '''returns field -> (value, timestamp) of the last line logged at or before when (a datetime) for each field,
+        e.g. the conditions of a recorded capture. The lines of the minute of when count as before it'''
+        with open(self.path, 'rb') as f:
+            end = self.offsetAfter(f, when, os.fstat(f.fileno()).st_size)
+            found = self.decode(self.scanBackwards(f, 0, end))
+        return {key: (value, timestamp) for key, (value, timestamp, line) in found.items()}
+
+    def latest(self):
+        '''returns field -> (value, timestamp) of the last line logged for each field found so far'''
+        self.update()
+        fields = dict(self.fields)
+        fields.update(self.pending)
+        return {key: (value, timestamp) for key, (value, timestamp, line) in fields.items()}
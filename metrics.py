@@ -0,0 +1,215 @@
+
+# Timing of the acquisition stages and event counters.
+# The stages are timed with the monotonic clock into log-bucket (HDR-style) histograms, which keep ~3% precision
+# from nanoseconds to minutes in a fixed number of buckets. Nothing is recorded until enable() is called:
+# the hot paths then only pay for a call returning a shared do-nothing span.
+
+import os
+import threading
+import time
+from datetime import datetime
+
+#sub-buckets per power of two: 2**SUB_BITS, i.e. a relative precision of 1/2**SUB_BITS
+SUB_BITS=5
+#largest value kept apart (ns): about 18 minutes, longer spans go in the last bucket
+MAX_BITS=40
+#seconds between two rewrites of the metrics file
+METRICS_INTERVAL=10.0
+
+class Histogram:
+    '''counts of values (ns) in log buckets: values below 2**SUB_BITS have a bucket each,
+    every following power of two is split into 2**SUB_BITS buckets'''
+    SUB=1 << SUB_BITS
+
+    def __init__(self):
+        self.counts=[0] * ((MAX_BITS - SUB_BITS + 1) * self.SUB)
+        self.count=0
+        self.total=0
+        self.min=None
+        self.max=0
+
+    def index(self, value):
+        if value < self.SUB:
+            return max(value, 0)
+        shift=value.bit_length() - 1 - SUB_BITS
+        return min((shift + 1) * self.SUB + (value >> shift) - self.SUB, len(self.counts) - 1)
+
+    def lowest(self, index):
+        '''smallest value of a bucket'''
+        if index < self.SUB:
+            return index
+        shift=index // self.SUB - 1
+        return (self.SUB + index % self.SUB) << shift
+
+    def record(self, value):
+        self.counts[self.index(value)]+=1
+        self.count+=1
+        self.total+=value
+        if self.min is None or value < self.min:
+            self.min=value
+        if value > self.max:
+            self.max=value
+
+    def percentile(self, p):
+        '''value below which p percent of the values are (middle of its bucket, within the recorded range)'''
+        if not self.count:
+            return 0
+        rank=p / 100 * self.count
+        seen=0
+        for i, n in enumerate(self.counts):
+            seen+=n
+            if n and seen >= rank:
+                middle=(self.lowest(i) + self.lowest(i + 1)) / 2 if i + 1 < len(self.counts) else self.lowest(i)
+                return min(max(middle, self.min), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+class Span:
+    '''times the with block into the histogram of its stage'''
+    __slots__=('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics=metrics
+        self.name=name
+
+    def __enter__(self):
+        self.start=time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.name, time.perf_counter_ns() - self.start)
+        return False
+
+class NullSpan:
+    '''span of the disabled metrics: does nothing'''
+    __slots__=()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN=NullSpan()
+
+class Metrics:
+    '''stage histograms, event counters and watched values (read only when exported) of one process.
+    path: file rewritten every interval seconds with the current metrics (nothing written if empty)'''
+    def __init__(self, path='', interval=METRICS_INTERVAL):
+        self.path=path
+        self.interval=interval
+        self.histograms={}
+        self.counters={}
+        self.watched={}
+        self.started=time.monotonic()
+        self.stopEvent=threading.Event()
+        self.writer=None
+        if path:
+            self.writer=threading.Thread(target=self.writePeriodically, name='metrics', daemon=True)
+            self.writer.start()
+
+    def span(self, name):
+        return Span(self, name)
+
+    def record(self, name, ns):
+        histogram=self.histograms.get(name)
+        if histogram is None:
+            histogram=self.histograms.setdefault(name, Histogram())
+        histogram.record(ns)
+
+    def count(self, name, n=1):
+        self.counters[name]=self.counters.get(name, 0) + n
+
+    def watch(self, name, read):
+        '''read() is called at every export, e.g. to show a counter kept by another process'''
+        self.watched[name]=read
+
+    def format(self):
+        '''the metrics as text: counters (with their rate) and the percentiles of every stage in ms'''
+        elapsed=time.monotonic() - self.started
+        lines=['# metrics at ' + datetime.strftime(datetime.now(), '%d/%m/%Y %H:%M:%S') +
+               ', {:.1f} s since start'.format(elapsed), '', 'counters:']
+        counters=dict(self.counters)
+        for name, read in list(self.watched.items()):
+            try:
+                counters[name]=read()
+            except Exception as e:
+                print("metrics: cannot read " + name + ": " + str(e))
+        for name in sorted(counters):
+            lines.append('  {:<24s}{:>12d}  {:>10.2f}/s'.format(name, int(counters[name]), counters[name] / elapsed))
+        lines.append('')
+        lines.append('stages [ms]:             count        mean         p50         p90         p99         max')
+        for name in sorted(self.histograms):
+            h=self.histograms[name]
+            lines.append('  {:<18s}{:>12d}'.format(name, h.count) +
+                         ''.join('{:>12.4f}'.format(v / 1e6) for v in
+                                 (h.mean(), h.percentile(50), h.percentile(90), h.percentile(99), h.max)))
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        '''rewrites the metrics file (replaced at once, a reader never sees half a file)'''
+        if not self.path:
+            return
+        tmp=self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.format())
+        os.replace(tmp, self.path)
+
+    def writePeriodically(self):
+        while not self.stopEvent.wait(self.interval):
+            try:
+                self.export()
+            except OSError as e:
+                print("Failed to write the metrics: " + str(e) + "\n")
+
+    def close(self):
+        '''stops the periodic export, writes the file a last time and prints the summary'''
+        self.stopEvent.set()
+        if self.writer is not None:
+            self.writer.join()
+        self.export()
+        print(self.format())
+
+class NullMetrics:
+    '''disabled metrics: same interface as Metrics, records nothing'''
+    def span(self, name):
+        return NULL_SPAN
+
+    def record(self, name, ns):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def watch(self, name, read):
+        pass
+
+    def close(self):
+        pass
+
+#metrics of this process, disabled until enable()
+current=NullMetrics()
+
+def enable(path='', interval=METRICS_INTERVAL):
+    '''starts recording the metrics of this process (and rewriting them into path if given)'''
+    global current
+    current=Metrics(path, interval)
+    return current
+
+def disable():
+    '''stops recording, writes the last metrics and prints the summary'''
+    global current
+    current.close()
+    current=NullMetrics()
+
+def span(name):
+    '''with span('stage'): times the block as stage'''
+    return current.span(name)
+
+def count(name, n=1):
+    current.count(name, n)
+
+def watch(name, read):
+    current.watch(name, read)
@@ -0,0 +1,263 @@
+
+# Acquisition pipeline: the oscilloscope is read in its own thread into pre-allocated frames,
+# which are processed (statistics, plot, measurement points) and persisted (CSV, raw recording)
+# in two other threads, so USB transfers run back to back while the analysis goes on.
+
+import queue
+import threading
+import time
+import numpy as np
+import metrics
+from deviceControl_4probe import NUM_SAMPLES
+
+#captures waiting to be processed, and points (or frames to record) waiting to be written
+FRAME_QUEUE=8
+PERSIST_QUEUE=32
+#longest sleep between two checks of the stop request while idle (s): a retry request wakes the acquisition at once
+IDLE_CHECK=0.5
+
+class Frame:
+    '''one capture, copied out of the device buffers'''
+    def __init__(self, n=NUM_SAMPLES):
+        self.allocate(n)
+        self.pointDue = None
+        self.generation = None
+
+    def allocate(self, n):
+        self.data = np.empty((2, n), dtype=np.float32)
+        self.raw = np.empty((2, n), dtype=np.int16)
+        self.bufA, self.bufB = self.data
+        self.rawA, self.rawB = self.raw
+
+    def fill(self, dev, time, bufA, bufB, keepRaw=False):
+        if len(bufA) != self.data.shape[1]:
+            self.allocate(len(bufA))
+        self.data[0] = bufA
+        self.data[1] = bufB
+        if keepRaw:
+            self.raw[0] = dev.rawA
+            self.raw[1] = dev.rawB
+        # the device replaces its time axis when the configuration changes, it never rewrites it
+        self.time = time
+        self.timebase = dev.timebase
+        self.interval_ns = dev.timeInterval.value
+        self.overflow = dev.overflowFlags
+        self.rangeA = dev.captureRanges['A'] #autoRange may have changed dev.ranges after the capture
+        self.rangeB = dev.captureRanges['B']
+        self.captureTime = dev.captureTime
+
+class DutyCycle:
+    '''wall-clock schedule of the acquisition: a burst of burst captures ends at every deadline
+    (every period seconds), and the unit and the CPU are idle in between.
+    The last capture of a burst is marked pointDue; if the point it makes is rejected, the acquisition
+    goes on capture by capture (every one marked pointDue) until a point is accepted.
+    Every burst has a generation number, shared by its retries: a capture still in flight when its point
+    was accepted carries an accepted generation and must not make a second point.
+    start: time (s since the epoch) of the first point, by default the first burst starts at once'''
+    def __init__(self, period, burst, start=None):
+        self.period = period
+        self.burst = burst
+        self.deadline = start
+        self.remaining = 0 #captures left in the current burst
+        self.captureDuration = 0.0 #average time per capture (s), to start the bursts in time
+        self.generation = 0 #of the current burst
+        self.retry = False
+        self.wakeup = threading.Event() #set when a point is rejected, or to stop
+
+    def waitBurst(self, dev, stop):
+        '''called before every capture: sleeps (the unit paused) until the next burst has to start.
+        Returns False if stop was set meanwhile'''
+        if self.remaining or self.retry:
+            return True
+        paused = False
+        while self.deadline is not None and not stop.is_set() and not self.retry:
+            delay = self.deadline - self.burst * self.captureDuration - time.time()
+            if delay <= 0:
+                break
+            if delay > self.period: #the clock was set back
+                self.deadline = time.time() + self.period
+                continue
+            if not paused:
+                dev.pause()
+                paused = True
+            self.wakeup.wait(min(delay, IDLE_CHECK))
+            self.wakeup.clear()
+        if paused:
+            dev.resume()
+        if stop.is_set():
+            return False
+        if not self.retry:
+            self.remaining = self.burst
+            self.generation = self.generation + 1
+        return True
+
+    def captured(self, duration):
+        '''called after every capture with the time it took, returns True if a point is due after it'''
+        self.captureDuration = duration if not self.captureDuration else 0.9 * self.captureDuration + 0.1 * duration
+        if not self.remaining:
+            return self.retry #retrying, unless the point was accepted during the capture
+        self.remaining = self.remaining - 1
+        if self.remaining:
+            return False
+        now = time.time()
+        self.deadline = (now if self.deadline is None else self.deadline) + self.period
+        while self.deadline <= now: #deadlines missed (e.g. while retrying) are skipped
+            self.deadline = self.deadline + self.period
+        return True
+
+    def pointDone(self, accepted, generation):
+        '''called by the processing with the outcome of every point due and the generation of its capture'''
+        if generation != self.generation:
+            return #a late outcome of an earlier burst
+        self.retry = not accepted
+        if self.retry:
+            self.wake()
+
+    def wake(self):
+        '''ends the idle wait of waitBurst at once'''
+        self.wakeup.set()
+
+class AcquisitionPipeline:
+    '''runs acquisition, processing and persistence in three threads connected by bounded queues.
+    process(frame) runs in the processing thread and returns a point to persist (or None),
+    persist(point) runs in the persistence thread, and so does record(frame) if given (raw recording).
+    policy: what the acquisition does when processing falls behind:
+    'drop' replaces the oldest capture waiting in the queue (counted in dropped), 'block' waits.
+    Persistence is lossless: processing waits when the persistence queue is full.
+    stop: Event ending the acquisition (the queues are drained before run returns)
+    schedule: DutyCycle pacing the acquisition, every capture is taken as soon as possible without it
+    (frame.pointDue and frame.generation are then None)'''
+    def __init__(self, dev, process, persist, record=None, policy='drop', stop=None,
+                 frames=FRAME_QUEUE, persistQueue=PERSIST_QUEUE, schedule=None):
+        self.dev = dev
+        self.schedule = schedule
+        self.process = process
+        self.persist = persist
+        self.record = record
+        self.policy = policy
+        self.stopEvent = stop if stop is not None else threading.Event()
+        self.frames = queue.Queue(frames)
+        self.persistQueue = queue.Queue(persistQueue)
+        # one frame per queue slot, plus the one being filled and the one being processed
+        self.pool = queue.Queue()
+        for i in range(frames + 2):
+            self.pool.put(Frame())
+        self.captures = 0
+        self.dropped = 0
+        self.replayFinished = False
+        self.error = None
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.schedule is not None:
+            self.schedule.wake()
+
+    def fail(self, error):
+        '''a stage failed: the acquisition stops, the other stages only drain their queues'''
+        if self.error is None:
+            self.error = error
+        self.stop()
+
+    def freeFrame(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            pass
+        if self.policy == 'drop':
+            try:
+                frame = self.frames.get_nowait() #the oldest capture waiting
+                self.dropped = self.dropped + 1
+                metrics.count('captures_dropped')
+                return frame
+            except queue.Empty:
+                pass
+        return self.pool.get() #all the frames are waiting to be recorded
+
+    def acquire(self):
+        try:
+            while not self.stopEvent.is_set():
+                if self.schedule is not None and not self.schedule.waitBurst(self.dev, self.stopEvent):
+                    break
+                start = time.perf_counter()
+                with metrics.span('capture'):
+                    timeAxis, bufA, bufB = self.dev.getData()
+                pointDue = generation = None
+                if self.schedule is not None:
+                    pointDue = self.schedule.captured(time.perf_counter() - start)
+                    generation = self.schedule.generation
+                frame = self.freeFrame()
+                frame.fill(self.dev, timeAxis, bufA, bufB, self.record is not None)
+                frame.pointDue = pointDue
+                frame.generation = generation
+                if self.policy == 'drop' and self.frames.full():
+                    try:
+                        self.pool.put(self.frames.get_nowait())
+                        self.dropped = self.dropped + 1
+                        metrics.count('captures_dropped')
+                    except queue.Empty:
+                        pass
+                self.frames.put(frame)
+                self.captures = self.captures + 1
+                metrics.count('captures')
+        except EOFError:
+            self.replayFinished = True
+        except Exception as e:
+            self.fail(e)
+        finally:
+            self.frames.put(None)
+
+    def processFrames(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            if self.error is None:
+                try:
+                    point = self.process(frame)
+                    if point is not None:
+                        self.persistQueue.put(('point', point))
+                    if self.record is not None:
+                        self.persistQueue.put(('frame', frame))
+                        continue
+                except Exception as e:
+                    self.fail(e)
+            self.pool.put(frame)
+        self.persistQueue.put(None)
+
+    def persistItems(self):
+        while True:
+            item = self.persistQueue.get()
+            if item is None:
+                break
+            kind, payload = item
+            if self.error is None:
+                try:
+                    if kind == 'frame':
+                        self.record(payload)
+                    else:
+                        self.persist(payload)
+                except Exception as e:
+                    self.fail(e)
+            if kind == 'frame':
+                self.pool.put(payload)
+
+    def run(self):
+        '''runs until stop() is called, Ctrl-C, the end of a replay or an error (raised again here)'''
+        threads = [threading.Thread(target=self.acquire, name='acquisition', daemon=True),
+                   threading.Thread(target=self.processFrames, name='processing', daemon=True),
+                   threading.Thread(target=self.persistItems, name='persistence', daemon=True)]
+        for thread in threads:
+            thread.start()
+        try:
+            while threads[0].is_alive():
+                threads[0].join(timeout=0.2)
+        except KeyboardInterrupt:
+            print('Interrupted')
+            self.stop()
+        for thread in threads:
+            thread.join()
+        if self.replayFinished:
+            print('Replay finished')
+        print("Pipeline stopped: " + str(self.captures) + " captures, " + str(self.dropped) + " dropped.\n")
+        if self.error is not None:
+            raise self.error
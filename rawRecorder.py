@@ -0,0 +1,139 @@
+
+# Append-only recording of the raw captures (int16 ADC counts of channel A and B) and their replay.
+# A recording is a directory of chunk files holding the frames back to back, plus an index
+# with one fixed size record per frame (where it is stored and how it was captured).
+
+import ctypes
+import os
+import time
+import zlib
+import numpy as np
+from deviceControl_4probe import MAX_ADC, PS2000_RANGE_MV, NANO2MILI
+
+INDEX_FILE = 'index.bin'
+CHUNK_FILE = 'chunk_{:06d}.bin'
+#one record per frame
+INDEX_DTYPE = np.dtype([('chunk', '<u4'), ('offset', '<u8'), ('length', '<u4'), ('samples', '<u4'),
+                        ('timestamp', '<f8'), ('interval_ns', '<f8'), ('timebase', '<i2'),
+                        ('rangeA', '<i2'), ('rangeB', '<i2'), ('overflow', '<i2'), ('compressed', '<u1')])
+
+class RawRecorder:
+    '''appends raw captures to a recording directory.
+    chunkFrames: frames per chunk file, compress: zlib-compress every frame (level 1, fast)'''
+    def __init__(self, path, chunkFrames=1000, compress=False):
+        self.path = path
+        self.chunkFrames = chunkFrames
+        self.compress = compress
+        os.makedirs(path, exist_ok=True)
+        indexPath = os.path.join(path, INDEX_FILE)
+        #an existing recording is continued in a new chunk
+        frames = os.path.getsize(indexPath) // INDEX_DTYPE.itemsize if os.path.exists(indexPath) else 0
+        self.chunk = int(np.fromfile(indexPath, dtype=INDEX_DTYPE)['chunk'][-1]) + 1 if frames else 0
+        self.index = open(indexPath, 'ab')
+        self.chunkFile = None
+        self.record = np.zeros(1, dtype=INDEX_DTYPE)
+
+    def openChunk(self):
+        if self.chunkFile is not None:
+            self.chunkFile.close()
+            self.chunk = self.chunk + 1
+        self.chunkFile = open(os.path.join(self.path, CHUNK_FILE.format(self.chunk)), 'ab')
+        self.chunkCount = 0
+
+    def addCapture(self, rawA, rawB, timebase, rangeA, rangeB, interval_ns, overflow=0, timestamp=None):
+        '''appends one capture: rawA, rawB are the int16 ADC counts, interval_ns the sample interval'''
+        if self.chunkFile is None or self.chunkCount >= self.chunkFrames:
+            self.openChunk()
+        payload = np.concatenate((rawA, rawB)).astype('<i2', copy=False).tobytes()
+        if self.compress:
+            payload = zlib.compress(payload, 1)
+        r = self.record[0]
+        r['chunk'] = self.chunk
+        r['offset'] = self.chunkFile.tell()
+        r['length'] = len(payload)
+        r['samples'] = len(rawA)
+        r['timestamp'] = time.time() if timestamp is None else timestamp
+        r['interval_ns'] = interval_ns
+        r['timebase'] = timebase
+        r['rangeA'] = rangeA
+        r['rangeB'] = rangeB
+        r['overflow'] = overflow
+        r['compressed'] = self.compress
+        self.chunkFile.write(payload)
+        self.chunkFile.flush()
+        self.index.write(self.record.tobytes())
+        self.index.flush()
+        self.chunkCount = self.chunkCount + 1
+
+    def close(self):
+        if self.chunkFile is not None:
+            self.chunkFile.close()
+        self.index.close()
+
+class RawReplay:
+    '''memory-mapped reader of a recording'''
+    def __init__(self, path):
+        self.path = path
+        indexPath = os.path.join(path, INDEX_FILE)
+        frames = os.path.getsize(indexPath) // INDEX_DTYPE.itemsize
+        self.index = np.memmap(indexPath, dtype=INDEX_DTYPE, mode='r', shape=(frames,)) if frames else \
+            np.zeros(0, dtype=INDEX_DTYPE)
+        self.chunks = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def chunk(self, number):
+        if number not in self.chunks:
+            self.chunks[number] = np.memmap(os.path.join(self.path, CHUNK_FILE.format(number)), dtype=np.uint8, mode='r')
+        return self.chunks[number]
+
+    def frame(self, i):
+        '''returns the int16 counts of channel A and B of frame i (views into the file unless compressed)
+        and its index record'''
+        r = self.index[i]
+        payload = self.chunk(int(r['chunk']))[r['offset']:r['offset'] + r['length']]
+        if r['compressed']:
+            payload = zlib.decompress(payload)
+        data = np.frombuffer(payload, dtype='<i2').reshape(2, int(r['samples']))
+        return data[0], data[1], r
+
+class ReplayDevice:
+    '''replays a recording through the same interface as DevControl (getData, timeInterval, closeDevice),
+    so the recorded captures go through the live pipeline.
+    realtime: wait between frames as long as they took when recorded, otherwise replay as fast as possible'''
+    def __init__(self, path, realtime=False):
+        print('replaying ' + path)
+        self.replay = RawReplay(path)
+        self.realtime = realtime
+        self.position = 0
+        self.timeInterval = ctypes.c_int32()
+        self.timeKey = None
+        self.ranges = {}
+        self.captureRanges = self.ranges
+
+    def getData(self):
+        '''returns the time axis (ms) and channel A and B (mV) of the next frame, raises EOFError at the end'''
+        if self.position >= len(self.replay):
+            raise EOFError("end of the recording")
+        self.rawA, self.rawB, r = self.replay.frame(self.position)
+        if self.realtime and self.position > 0:
+            time.sleep(max(r['timestamp'] - self.replay.index[self.position - 1]['timestamp'], 0))
+        self.position = self.position + 1
+        self.timebase = int(r['timebase'])
+        self.overflowFlags = int(r['overflow'])
+        self.captureTime = float(r['timestamp'])
+        self.timeInterval.value = int(r['interval_ns'])
+        self.ranges = {'A': int(r['rangeA']), 'B': int(r['rangeB'])}
+        self.captureRanges = self.ranges #a replayed frame keeps its ranges
+
+        self.bufA = self.rawA * np.float32(PS2000_RANGE_MV[r['rangeA']] / MAX_ADC)
+        self.bufB = self.rawB * np.float32(PS2000_RANGE_MV[r['rangeB']] / MAX_ADC)
+        key = (float(r['interval_ns']), len(self.rawA))
+        if key != self.timeKey:
+            self.time = np.linspace(0, len(self.rawA) * key[0], len(self.rawA))/NANO2MILI
+            self.timeKey = key
+        return self.time, self.bufA, self.bufB
+
+    def closeDevice(self):
+        print("Replay closed\n")
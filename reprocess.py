@@ -0,0 +1,137 @@
+
+# Batch reprocessing of saved measurement points: loads Picoresults_*.csv files into columns, recomputes the
+# compensated conductivity with new coefficients (all the points of a file at once) and saves every file
+# as a compressed .npz of columns. The files are processed in parallel, one per core.
+#
+#   python reprocess.py "C:/GluSense/Calibration/Picoresults_*.csv" --evaporation 0.000021 --out reprocessed
+
+import argparse
+import csv
+import glob
+import importlib
+import os
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+#CSV column -> npz array (float columns; the timestamp is kept as datetime64[m])
+COLUMNS = {'concentration [mg/dL]': 'concentration',
+           'target concentration [mg/dL]': 'target_concentration',
+           'volume [mL]': 'volume',
+           'temperature [Celsius]': 'temperature',
+           'V2 mean [mV]': 'V_mean',
+           'V2 std [uV]': 'V_std',
+           'I mean [mA]': 'I_mean',
+           'I std [uA]': 'I_std',
+           'conductivity [mS]': 'conductivity',
+           'compensated conductivity [mS]': 'compensated_conductivity',
+           'impedance [Ohm]': 'impedance',
+           'phase A-B [deg]': 'phase',
+           'phase [deg]': 'phase'} #the same A-B phase, in the files written before it was renamed
+
+def probe():
+    '''4_probe.py, where the live acquisition compensates every point'''
+    return importlib.import_module('4_probe')
+
+def defaultCoefficients():
+    '''evaporation_coeff, temperature_coeff and default_temp as set in 4_probe.py'''
+    live = probe()
+    return {'evaporation_coeff': live.evaporation_coeff,
+            'temperature_coeff': live.temperature_coeff,
+            'default_temp': live.default_temp}
+
+def toFloat(column):
+    '''float array of a text column, nan for empty cells'''
+    return np.array([float(x) if x else np.nan for x in column])
+
+def parseTimestamps(column):
+    '''"dd/mm/YYYY HH:MM" strings to datetime64[m]'''
+    return np.array([s[6:10] + '-' + s[3:5] + '-' + s[0:2] + 'T' + s[11:16] for s in column], dtype='datetime64[m]')
+
+def loadResults(filename):
+    '''the columns of a results file as arrays (the columns missing in older files are left out)'''
+    with open(filename, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = [row for row in reader if row]
+    columns = dict(zip(header, zip(*rows))) if rows else {name: () for name in header}
+    data = {COLUMNS[name]: toFloat(values) for name, values in columns.items() if name in COLUMNS}
+    data['timestamp'] = parseTimestamps(columns.get('timestamp', ()))
+    return data
+
+def startTime(filename):
+    '''start of the acquisition that wrote a results file, from its name (..._%Y_%m_%d_%H_%M.csv), None if not there'''
+    parts = os.path.splitext(os.path.basename(filename))[0].split('_')[-5:]
+    try:
+        return np.datetime64(datetime(*(int(part) for part in parts)), 'm')
+    except (TypeError, ValueError):
+        return None
+
+def evaporationStart(timestamps, concentration, start=None, default_conc=None):
+    '''time each point's evaporation is counted from, as measurementStage does: the first point since the
+    concentration last changed, and the start of the acquisition for the first points if they are at default_conc
+    (start is ignored if after the first point, e.g. for the output of a replay)'''
+    index = np.arange(len(concentration))
+    changed = np.ones(len(concentration), dtype=bool)
+    changed[1:] = concentration[1:] != concentration[:-1]
+    first = np.maximum.accumulate(np.where(changed, index, 0)) #first point at the same concentration
+    t0 = timestamps[first]
+    if start is not None and len(t0) and concentration[0] == default_conc and start <= timestamps[0]:
+        t0[first == 0] = start
+    return t0
+
+def compensate(data, evaporation_coeff, temperature_coeff, default_temp, start=None, default_conc=None):
+    '''compensated conductivity of all the points of a file, with the formula of the live acquisition'''
+    t0 = evaporationStart(data['timestamp'], data['concentration'], start, default_conc)
+    timedelay = (data['timestamp'] - t0) / np.timedelta64(1, 'm')
+    return probe().compensateConductivity(data['conductivity'], timedelay, data['temperature'],
+                                          evaporation_coeff, temperature_coeff, default_temp)
+
+def outputName(filename, outDir):
+    name = os.path.splitext(os.path.basename(filename))[0] + '.npz'
+    return os.path.join(outDir if outDir else os.path.dirname(filename), name)
+
+def reprocessFile(filename, coefficients, outDir=''):
+    '''recomputes one file and saves it as npz, returns the output name and the number of points'''
+    data = loadResults(filename)
+    data['compensated_conductivity'] = compensate(data, start=startTime(filename), default_conc=probe().default_conc,
+                                                  **coefficients)
+    for name, value in coefficients.items():
+        data[name] = np.array(value)
+    output = outputName(filename, outDir)
+    np.savez_compressed(output, **data)
+    return output, len(data['timestamp'])
+
+def reprocess(files, coefficients, outDir='', workers=None):
+    '''reprocesses the files in parallel, prints one line per file'''
+    if outDir:
+        os.makedirs(outDir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(reprocessFile, filename, coefficients, outDir): filename for filename in files}
+        for future, filename in futures.items():
+            try:
+                output, points = future.result()
+                print(filename + ": " + str(points) + " points -> " + output)
+            except Exception as e:
+                print("Failed to reprocess " + filename + ": " + str(e))
+
+def main():
+    ''' main function '''
+    coefficients = defaultCoefficients()
+    parser = argparse.ArgumentParser(description='recomputes the compensated conductivity of Picoresults CSV files')
+    parser.add_argument('files', nargs='+', help='CSV files or glob patterns')
+    parser.add_argument('--evaporation', type=float, default=coefficients['evaporation_coeff'],
+                        help='evaporation coefficient per minute')
+    parser.add_argument('--temperature', type=float, default=coefficients['temperature_coeff'],
+                        help='temperature coefficient per degree')
+    parser.add_argument('--default-temp', type=float, default=coefficients['default_temp'],
+                        help='reference temperature in Celsius')
+    parser.add_argument('--out', default='', help='output directory (default: next to every CSV)')
+    parser.add_argument('--workers', type=int, default=None, help='parallel processes (default: one per core)')
+    args = parser.parse_args()
+    files = sorted({f for pattern in args.files for f in (glob.glob(pattern) or [pattern])})
+    reprocess(files, {'evaporation_coeff': args.evaporation, 'temperature_coeff': args.temperature,
+                      'default_temp': args.default_temp}, args.out, args.workers)
+
+if __name__ == '__main__':
+    main()
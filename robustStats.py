@@ -0,0 +1,197 @@
+
+# Robust statistics of a sliding window: median and MAD (median absolute deviation) updated in O(log n)
+# per value with an indexable skiplist, so that single glitchy captures (bubbles, USB overflows)
+# can be recognized and kept out of the averages.
+
+from math import log, inf
+from random import random
+import numpy as np
+
+#a value is an outlier if it is further than OUTLIER_K robust standard deviations from the window median
+OUTLIER_K=5.0
+#the standard deviation of normally distributed values is MAD_SCALE times their MAD
+MAD_SCALE=1.4826
+#no value is rejected before the window holds MIN_ROBUST values
+MIN_ROBUST=10
+#after REGIME_RUN outliers in a row the level really changed (e.g. new liquid): they are accepted
+REGIME_RUN=5
+
+class End:
+    '''value of the skiplist tail, larger than any value'''
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+    def __ge__(self, other):
+        return True
+
+class Node:
+    __slots__=('value', 'next', 'width')
+
+    def __init__(self, value, next, width):
+        self.value=value
+        self.next=next
+        self.width=width
+
+NIL=Node(End(), [], [])
+
+class IndexableSkiplist:
+    '''sorted values with O(log n) insertion, removal, access by rank and rank of a value.
+    Every link also stores how many values it jumps over (its width)'''
+    def __init__(self, expected_size=100):
+        self.size=0
+        self.maxlevels=int(1 + log(max(expected_size, 2), 2))
+        self.head=Node('HEAD', [NIL] * self.maxlevels, [1] * self.maxlevels)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.size:
+            raise IndexError('skiplist index out of range')
+        node=self.head
+        i=i + 1
+        for level in reversed(range(self.maxlevels)):
+            while node.width[level] <= i:
+                i=i - node.width[level]
+                node=node.next[level]
+        return node.value
+
+    def bisectLeft(self, value):
+        '''number of values smaller than value'''
+        node=self.head
+        rank=0
+        for level in reversed(range(self.maxlevels)):
+            while node.next[level].value < value:
+                rank=rank + node.width[level]
+                node=node.next[level]
+        return rank
+
+    def insert(self, value):
+        chain=[None] * self.maxlevels
+        stepsAtLevel=[0] * self.maxlevels
+        node=self.head
+        for level in reversed(range(self.maxlevels)):
+            while node.next[level].value <= value:
+                stepsAtLevel[level]=stepsAtLevel[level] + node.width[level]
+                node=node.next[level]
+            chain[level]=node
+        #levels of the new node: 1 with probability 1/2, 2 with 1/4...
+        d=min(self.maxlevels, 1 - int(log(1.0 - random(), 2.0)))
+        newNode=Node(value, [None] * d, [None] * d)
+        steps=0
+        for level in range(d):
+            prevNode=chain[level]
+            newNode.next[level]=prevNode.next[level]
+            prevNode.next[level]=newNode
+            newNode.width[level]=prevNode.width[level] - steps
+            prevNode.width[level]=steps + 1
+            steps=steps + stepsAtLevel[level]
+        for level in range(d, self.maxlevels):
+            chain[level].width[level]=chain[level].width[level] + 1
+        self.size=self.size + 1
+
+    def remove(self, value):
+        chain=[None] * self.maxlevels
+        node=self.head
+        for level in reversed(range(self.maxlevels)):
+            while node.next[level].value < value:
+                node=node.next[level]
+            chain[level]=node
+        if value != chain[0].next[0].value:
+            raise KeyError('value not in the skiplist')
+        d=len(chain[0].next[0].next)
+        for level in range(d):
+            prevNode=chain[level]
+            prevNode.width[level]=prevNode.width[level] + prevNode.next[level].width[level] - 1
+            prevNode.next[level]=prevNode.next[level].next[level]
+        for level in range(d, self.maxlevels):
+            chain[level].width[level]=chain[level].width[level] - 1
+        self.size=self.size - 1
+
+class windowMedian:
+    '''median and MAD of the last size values, kept sorted in a skiplist next to a circular buffer.
+    Adding a value is O(log n), the median O(log n) and the MAD O(log² n)'''
+    def __init__(self, size):
+        self.size=size
+        self.values=[0.0] * size
+        self.count=0
+        self.pos=0
+        self.sorted=IndexableSkiplist(size)
+        self.cache=None #(median, mad) until the next value
+
+    def add(self, x):
+        x=float(x)
+        if self.count == self.size:
+            self.sorted.remove(self.values[self.pos])
+        else:
+            self.count=self.count + 1
+        self.values[self.pos]=x
+        self.sorted.insert(x)
+        self.pos=(self.pos + 1) % self.size
+        self.cache=None
+
+    def median(self):
+        n=self.count
+        if n == 0:
+            return np.nan
+        return (self.sorted[(n - 1) // 2] + self.sorted[n // 2]) / 2
+
+    def mad(self):
+        '''median of the distances to the median, read from the skiplist without sorting them:
+        the distances below the median and above it are two sorted sequences, merged by binary search'''
+        n=self.count
+        if n == 0:
+            return np.nan
+        s=self.sorted
+        m=self.median()
+        below=s.bisectLeft(m) #values smaller than the median
+        above=n - below
+
+        def left(i): #i-th smallest distance below the median
+            return m - s[below - 1 - i]
+
+        def right(j): #j-th smallest distance from the median up
+            return s[below + j] - m
+
+        def kth(k):
+            '''k-th smallest distance (from 0): i of the k+1 smallest are below the median'''
+            lo=max(0, k + 1 - above)
+            hi=min(k + 1, below)
+            while lo < hi:
+                i=(lo + hi) // 2
+                if left(i) < right(k - i):
+                    lo=i + 1
+                else:
+                    hi=i
+            return max(left(lo - 1) if lo > 0 else -inf, right(k - lo) if k - lo >= 0 else -inf)
+
+        return (kth((n - 1) // 2) + kth(n // 2)) / 2
+
+    def stats(self):
+        '''median and MAD, computed once per value added'''
+        if self.cache is None:
+            self.cache=(self.median(), self.mad())
+        return self.cache
+
+    def isOutlier(self, x, k=OUTLIER_K):
+        '''True if x is further than k robust standard deviations from the median of the window'''
+        if self.count < MIN_ROBUST:
+            return False
+        median, mad=self.stats()
+        return abs(x - median) > k * MAD_SCALE * mad > 0
+
+def trimmedStats(values, k=OUTLIER_K):
+    '''mean and standard deviation of the values within k robust standard deviations of their median'''
+    values=np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return 0.0, 0.0
+    median=np.median(values)
+    mad=np.median(np.abs(values - median))
+    kept=values[np.abs(values - median) <= k * MAD_SCALE * mad] if mad > 0 else values
+    return kept.mean(), kept.std()
@@ -0,0 +1,208 @@
+
+# Pure-Python stand-in for the PS2000 driver, so the acquisition loop can run
+# (and be profiled) on machines without a Picoscope or the Windows DLL.
+
+import ctypes
+import time
+import numpy as np
+from deviceControl_4probe import MAX_ADC, PS2000_RANGE_MV, sweepFrequencies
+
+def _value(arg):
+    '''returns the python value of a ctypes scalar (or the argument itself)'''
+    return arg.value if hasattr(arg, 'value') else arg
+
+def _target(arg):
+    '''returns the ctypes object behind a byref() argument'''
+    return getattr(arg, '_obj', arg)
+
+class SimulatedPS2000:
+    '''mimics the subset of the ps2000 API used by DevControl.
+    Arguments are accepted the same way ctypes passes them to the DLL
+    (c_* scalars, byref() references, ctypes arrays) and outputs are written back through them.
+
+    ampA, ampB: amplitude of channel A and B as a fraction of the generator peak voltage
+    phaseA, phaseB: phase of the channels relative to the generator (radians)
+    cornerA: corner frequency (Hz) of a first order low-pass in front of channel A, 0 for a flat response
+    noise: standard deviation of the added white noise in mV
+    latency: extra USB latency added to every block in seconds
+    overflow_prob: probability of a capture being flagged as overflowed on top of real clipping
+    realtime: if False, captures are available immediately instead of after the real capture time
+    '''
+    def __init__(self, ampA=0.3, ampB=0.9, phaseA=0.0, phaseB=0.0, cornerA=0.0, noise=1.0, latency=0.0,
+                 overflow_prob=0.0, realtime=True, serial='SIM00001', seed=None):
+        self.ampA=ampA
+        self.cornerA=cornerA
+        self.ampB=ampB
+        self.phaseA=phaseA
+        self.phaseB=phaseB
+        self.noise=noise
+        self.latency=latency
+        self.overflow_prob=overflow_prob
+        self.realtime=realtime
+        self.serial=serial
+        self.rng=np.random.default_rng(seed)
+
+        self.handle=0
+        self.ranges={0: 7, 1: 7}
+        self.enabled={0: 1, 1: 1}
+        self.sg_pktopk=0
+        self.sg_freq=0.0
+        self.sg_stopfreq=0.0
+        self.sg_increment=0.0
+        self.sg_dwell=0.0
+        self.sg_start=0.0
+        #sample clock, keeps the phase continuous between captures
+        self.clock=0.0
+        self.interval_ns=0
+        self.block_samples=0
+        self.block_ready_at=None
+        self.streaming=False
+        self.stream_delivered=0
+        self.stream_chunk=0
+
+    ### unit ###############
+    def ps2000_open_unit(self):
+        '''a simulated driver has one unit: 0 (no unit found) once it is open'''
+        if self.handle:
+            return 0
+        self.handle=1
+        return self.handle
+
+    def ps2000_close_unit(self, handle):
+        self.handle=0
+        return 1
+
+    def ps2000_get_unit_info(self, handle, string, string_length, line):
+        info=self.serial.encode()[:_value(string_length) - 1]
+        ctypes.memmove(string, info + b'\0', len(info) + 1)
+        return len(info)
+
+    ### setup ###############
+    def ps2000_set_channel(self, handle, channel, enabled, dc, range):
+        self.enabled[_value(channel)]=_value(enabled)
+        self.ranges[_value(channel)]=_value(range)
+        return 1
+
+    def ps2000_set_trigger(self, handle, source, threshold, direction, delay, auto_trigger_ms):
+        return 1
+
+    def ps2000_set_sig_gen_built_in(self, handle, offset, pktopk, wavetype, startfreq, stopfreq,
+                                    increment, dwell, sweeptype, sweeps):
+        self.sg_pktopk=_value(pktopk)
+        self.sg_freq=_value(startfreq)
+        self.sg_stopfreq=_value(stopfreq)
+        self.sg_increment=_value(increment)
+        self.sg_dwell=_value(dwell)
+        self.sg_start=self.clock
+        return 1
+
+    def ps2000_get_timebase(self, handle, timebase, no_of_samples, time_interval, time_units,
+                            oversample, max_samples):
+        #10 ns at timebase 0, doubling with every timebase
+        _target(time_interval).value=10 * 2 ** _value(timebase)
+        _target(time_units).value=2 # ns
+        _target(max_samples).value=8064
+        return 1
+
+    ### block mode ###############
+    def ps2000_run_block(self, handle, no_of_samples, timebase, oversample, time_indisposed_ms):
+        self.block_samples=_value(no_of_samples)
+        self.interval_ns=10 * 2 ** _value(timebase)
+        duration=self.block_samples * self.interval_ns * 1e-9
+        if self.realtime:
+            _target(time_indisposed_ms).value=int(np.ceil(duration * 1000))
+            self.block_ready_at=time.perf_counter() + duration + self.latency
+        else:
+            _target(time_indisposed_ms).value=0
+            self.block_ready_at=time.perf_counter()
+        return 1
+
+    def ps2000_ready(self, handle):
+        if self.block_ready_at is None:
+            return 0
+        return 1 if time.perf_counter() >= self.block_ready_at else 0
+
+    def ps2000_get_values(self, handle, buffer_a, buffer_b, buffer_c, buffer_d, overflow, no_of_values):
+        n=min(_value(no_of_values), self.block_samples)
+        dataA, dataB, flags=self.generate(n, self.interval_ns * 1e-9)
+        for buf, data in ((buffer_a, dataA), (buffer_b, dataB)):
+            if buf is not None:
+                np.frombuffer(_target(buf), dtype=np.int16, count=n)[:]=data
+        if overflow is not None:
+            _target(overflow).value=flags
+        self.block_ready_at=None
+        return n
+
+    ### streaming mode ###############
+    def ps2000_run_streaming_ns(self, handle, sample_interval, time_units, max_samples, auto_stop,
+                                no_of_samples_per_aggregate, overview_buffer_size):
+        #time units: 0 fs, 1 ps, 2 ns, 3 us, 4 ms, 5 s
+        self.interval_ns=_value(sample_interval) * 10.0 ** (3 * (_value(time_units) - 2))
+        self.stream_chunk=_value(overview_buffer_size)
+        self.stream_started=time.perf_counter() + self.latency
+        self.stream_delivered=0
+        self.streaming=True
+        return 1
+
+    def ps2000_get_streaming_last_values(self, handle, callback):
+        '''calls back with the samples collected since the previous call (at most one overview buffer)'''
+        if not self.streaming:
+            return 0
+        if self.realtime:
+            elapsed=time.perf_counter() - self.stream_started
+            n=int(elapsed / (self.interval_ns * 1e-9)) - self.stream_delivered
+            n=min(n, self.stream_chunk)
+        else:
+            n=self.stream_chunk
+        if n <= 0:
+            return 0
+        dataA, dataB, flags=self.generate(n, self.interval_ns * 1e-9)
+        self.stream_delivered=self.stream_delivered + n
+        int16_p=ctypes.POINTER(ctypes.c_int16)
+        # max and min overview buffers of A and B (identical when not aggregating)
+        buffers=(int16_p * 4)(dataA.ctypes.data_as(int16_p), dataA.ctypes.data_as(int16_p),
+                              dataB.ctypes.data_as(int16_p), dataB.ctypes.data_as(int16_p))
+        callback(buffers, flags, 0, 0, 0, n)
+        return 1
+
+    def ps2000_stop(self, handle):
+        self.streaming=False
+        self.block_ready_at=None
+        return 1
+
+    ### signal model ###############
+    def generatorPhase(self, t):
+        '''phase (rad) and frequency (Hz) of the generator at the times t: a fixed frequency, or an up sweep
+        stepping by sg_increment every sg_dwell seconds from the time it was set, phase continuous'''
+        if self.sg_increment <= 0 or self.sg_dwell <= 0 or self.sg_stopfreq <= self.sg_freq:
+            return 2 * np.pi * self.sg_freq * t, self.sg_freq
+        freqs=sweepFrequencies(self.sg_freq, self.sg_stopfreq, self.sg_increment)
+        #turns completed at the start of every step
+        turns=np.concatenate(([0.0], np.cumsum(freqs * self.sg_dwell)))
+        elapsed=t - self.sg_start
+        step=np.floor(elapsed / self.sg_dwell).astype(np.int64)
+        sweeps, k=np.divmod(step, len(freqs))
+        phase=sweeps * turns[-1] + turns[k] + freqs[k] * (elapsed - step * self.sg_dwell)
+        return 2 * np.pi * phase, freqs[k]
+
+    def generate(self, n, dt):
+        '''generates n samples for both channels, continuing the sample clock.
+        Returns the ADC counts of channel A and B and the overflow flags'''
+        t=self.clock + np.arange(n) * dt
+        self.clock=self.clock + n * dt
+        peak=self.sg_pktopk / 2000.0 # uV peak to peak -> mV peak
+        phase, freq=self.generatorPhase(t)
+        flags=0
+        out=[]
+        gainA=1.0
+        if self.cornerA:
+            gainA=1 / (1 + 1j * freq / self.cornerA)
+        for ch, amp, ph in ((0, self.ampA * gainA, self.phaseA), (1, self.ampB, self.phaseB)):
+            mV=np.abs(amp) * peak * np.sin(phase + ph + np.angle(amp))
+            if self.noise:
+                mV=mV + self.rng.normal(0.0, self.noise, n)
+            counts=np.rint(mV * (MAX_ADC / PS2000_RANGE_MV[self.ranges[ch]]))
+            if np.abs(counts).max(initial=0) > MAX_ADC or self.rng.random() < self.overflow_prob:
+                flags=flags | (1 << ch)
+            out.append(np.clip(counts, -MAX_ADC, MAX_ADC).astype(np.int16))
+        return out[0], out[1], flags
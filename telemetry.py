@@ -0,0 +1,279 @@
+
+# Publish/subscribe telemetry on a local socket: any number of dashboards or loggers can subscribe
+# to the decimated waveforms, the running statistics and the accepted measurement points.
+# The server never waits for a subscriber: one that does not keep up is disconnected.
+#
+# Every message is a 32 byte header followed by its payload (little endian):
+#   magic b'PT', version, kind, source (16 bytes, e.g. the serial number), timestamp (float64, s since the epoch),
+#   payload length (uint32)
+# payloads:
+#   HELLO        JSON: {"version": 1, "measurement": [names of the measurement values]}, sent once on connecting
+#   WAVEFORM     n (uint32), then n float32 time (ms), n float32 channel A (mV), n float32 channel B (mV)
+#   STATS        V mean (mV), V std (uV), I mean (mA), I std (uA), A-B phase mean and std (deg): float64,
+#                then values in the window and captures rejected (uint32)
+#   MEASUREMENT  one float64 per measurement value, in the order given by HELLO
+#
+#   python telemetry.py localhost:5757     prints the messages of a running acquisition
+
+import json
+import os
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+import numpy as np
+import metrics
+
+MAGIC=b'PT'
+VERSION=1
+HELLO, WAVEFORM, STATS, MEASUREMENT=range(4)
+KINDS={HELLO: 'hello', WAVEFORM: 'waveform', STATS: 'stats', MEASUREMENT: 'measurement'}
+HEADER=struct.Struct('<2sBB16sdI')
+STATS_FORMAT=struct.Struct('<6d2I')
+#bytes waiting to be sent to one subscriber before it is disconnected
+SUBSCRIBER_BUFFER=4 << 20
+#bytes taken from the queue of a subscriber at a time, to be sent without holding the publish lock
+SEND_CHUNK=64 << 10
+
+def parseAddress(address):
+    '''"host:port" is a TCP address, anything else the path of a Unix domain socket (not on Windows)'''
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or 'localhost', int(port))
+    if not hasattr(socket, 'AF_UNIX'):
+        raise ValueError("Telemetry address " + repr(address) + " is not host:port, and Unix domain sockets "
+                         "are not available on this platform")
+    return socket.AF_UNIX, address
+
+def frame(kind, source, payload, timestamp=None):
+    '''a message: header and payload'''
+    return HEADER.pack(MAGIC, VERSION, kind, source.encode('utf8')[:16], time.time() if timestamp is None else timestamp,
+                       len(payload)) + payload
+
+class Subscriber:
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.sending = memoryview(b'') #part of the chunk taken from buffer not sent yet
+        self.writing = False
+        self.dropped = False
+
+class TelemetryServer:
+    '''publishes telemetry to every connected subscriber.
+    address: "localhost:port" (TCP) or the path of a Unix domain socket.
+    measurementFields: names of the values of a measurement point (sent to every subscriber in HELLO).
+    The publish methods can be called from any thread and never block: the messages are queued per
+    subscriber and sent by the server thread; a subscriber with more than bufferSize bytes queued is dropped'''
+    def __init__(self, address, measurementFields=(), bufferSize=SUBSCRIBER_BUFFER):
+        self.address = address
+        self.measurementFields = [name for name in measurementFields]
+        self.bufferSize = bufferSize
+        family, target = parseAddress(address)
+        if family == socket.AF_UNIX and os.path.exists(target):
+            os.remove(target) #left by an earlier run
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(target)
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.path = target if family == socket.AF_UNIX else None
+        self.wakeRead, self.wakeWrite = socket.socketpair()
+        self.wakeRead.setblocking(False)
+        self.wakeWrite.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.selector.register(self.wakeRead, selectors.EVENT_READ)
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.serve, name='telemetry', daemon=True)
+        self.thread.start()
+        print('telemetry on ' + address)
+
+    def publish(self, kind, source, payload, timestamp=None):
+        '''queues a message for every subscriber (nothing is encoded if there is none)'''
+        if not self.subscribers:
+            return
+        message = frame(kind, source, payload, timestamp)
+        with self.lock:
+            for subscriber in self.subscribers:
+                if subscriber.dropped:
+                    continue
+                if len(subscriber.buffer) + len(message) > self.bufferSize:
+                    subscriber.dropped = True #too slow: closed by the server thread
+                else:
+                    subscriber.buffer += message
+        self.wake()
+
+    def publishWaveform(self, source, time, chA, chB):
+        n = len(time)
+        self.publish(WAVEFORM, source, struct.pack('<I', n) + np.asarray(time, dtype='<f4').tobytes() +
+                     np.asarray(chA, dtype='<f4').tobytes() + np.asarray(chB, dtype='<f4').tobytes())
+
+    def publishStats(self, source, Vavg, Vstd, Iavg, Istd, phase, phaseStd, count, rejected):
+        self.publish(STATS, source, STATS_FORMAT.pack(Vavg, Vstd, Iavg, Istd, phase, phaseStd, count, rejected))
+
+    def publishMeasurement(self, source, fields, timestamp):
+        '''fields: name -> value of a measurement point (as measurement.formatOutput), timestamp in s since the epoch'''
+        values = [fields.get(name, np.nan) for name in self.measurementFields]
+        self.publish(MEASUREMENT, source, np.array(values, dtype='<f8').tobytes(), timestamp)
+
+    def wake(self):
+        try:
+            self.wakeWrite.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass #already woken up, or closing
+
+    def accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        subscriber = Subscriber(sock)
+        subscriber.buffer += frame(HELLO, '', json.dumps({'version': VERSION,
+                                                          'measurement': self.measurementFields}).encode('utf8'))
+        self.selector.register(sock, selectors.EVENT_READ, subscriber)
+        with self.lock:
+            self.subscribers = self.subscribers + [subscriber]
+
+    def remove(self, subscriber):
+        self.selector.unregister(subscriber.sock)
+        subscriber.sock.close()
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not subscriber]
+
+    def serve(self):
+        while not self.closed:
+            with self.lock:
+                subscribers = list(self.subscribers)
+            for subscriber in subscribers:
+                if subscriber.dropped:
+                    self.dropped = self.dropped + 1
+                    metrics.count('telemetry_subscribers_dropped')
+                    print("Telemetry subscriber too slow, disconnected.\n")
+                    self.remove(subscriber)
+                    continue
+                writing = len(subscriber.buffer) > 0 or len(subscriber.sending) > 0
+                if writing != subscriber.writing:
+                    events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+                    self.selector.modify(subscriber.sock, events, subscriber)
+                    subscriber.writing = writing
+            for key, mask in self.selector.select(timeout=1.0):
+                if key.fileobj is self.listener:
+                    self.accept()
+                elif key.fileobj is self.wakeRead:
+                    try:
+                        while self.wakeRead.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                else:
+                    self.service(key.data, mask)
+
+    def service(self, subscriber, mask):
+        '''reads (and ignores) what the subscriber sends, writes what is queued for it'''
+        try:
+            if mask & selectors.EVENT_READ:
+                if not subscriber.sock.recv(4096): #disconnected
+                    self.remove(subscriber)
+                    return
+            if mask & selectors.EVENT_WRITE:
+                if not subscriber.sending:
+                    #only a bounded chunk is copied under the lock, publish appends to the rest meanwhile
+                    with self.lock:
+                        subscriber.sending = memoryview(subscriber.buffer[:SEND_CHUNK])
+                        del subscriber.buffer[:SEND_CHUNK]
+                sent = subscriber.sock.send(subscriber.sending)
+                subscriber.sending = subscriber.sending[sent:]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.remove(subscriber)
+
+    def close(self):
+        self.closed = True
+        self.wake()
+        self.thread.join(timeout=2)
+        for subscriber in list(self.subscribers):
+            self.remove(subscriber)
+        self.selector.close()
+        self.listener.close()
+        self.wakeRead.close()
+        self.wakeWrite.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+class TelemetryClient:
+    '''subscribes to a TelemetryServer: receive() returns the next message as (kind, source, timestamp, value)
+    with value the decoded payload, or None once the server is gone'''
+    def __init__(self, address):
+        family, target = parseAddress(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(target)
+        self.file = self.sock.makefile('rb')
+        self.measurementFields = []
+
+    def read(self, n):
+        data = self.file.read(n)
+        if len(data) < n:
+            return None
+        return data
+
+    def receive(self):
+        header = self.read(HEADER.size)
+        if header is None:
+            return None
+        magic, version, kind, source, timestamp, length = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a telemetry stream (or another version)")
+        payload = self.read(length)
+        if payload is None:
+            return None
+        source = source.rstrip(b'\0').decode('utf8')
+        if kind == HELLO:
+            value = json.loads(payload.decode('utf8'))
+            self.measurementFields = value['measurement']
+        elif kind == WAVEFORM:
+            n = struct.unpack_from('<I', payload)[0]
+            data = np.frombuffer(payload, dtype='<f4', offset=4, count=3 * n).reshape(3, n)
+            value = (data[0], data[1], data[2])
+        elif kind == STATS:
+            value = dict(zip(('V mean [mV]', 'V std [uV]', 'I mean [mA]', 'I std [uA]', 'phase A-B [deg]',
+                              'phase A-B std [deg]', 'values', 'rejected'), STATS_FORMAT.unpack(payload)))
+        elif kind == MEASUREMENT:
+            value = dict(zip(self.measurementFields, np.frombuffer(payload, dtype='<f8').tolist()))
+        else:
+            value = payload #newer kinds are passed through
+        return KINDS.get(kind, kind), source, timestamp, value
+
+    def __iter__(self):
+        while True:
+            message = self.receive()
+            if message is None:
+                return
+            yield message
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+def main():
+    ''' prints the telemetry of a running acquisition '''
+    client = TelemetryClient(sys.argv[1] if len(sys.argv) > 1 else 'localhost:5757')
+    try:
+        for kind, source, timestamp, value in client:
+            if kind == 'waveform':
+                value = str(len(value[0])) + ' points'
+            print(time.strftime('%H:%M:%S', time.localtime(timestamp)), kind, source, value)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+
+if __name__ == '__main__':
+    main()